@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import signal
 
 from rest_tools.server import from_environment
 
@@ -28,4 +29,7 @@ logging.basicConfig(format=logformat, level=setlevel[config['LOG_LEVEL'].upper()
 
 # start server
 create_server()
-asyncio.get_event_loop().run_forever()
+loop = asyncio.get_event_loop()
+# stop cleanly on SIGTERM, so exit handlers run
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+loop.run_forever()
@@ -0,0 +1,106 @@
+from collections import Counter
+import math
+
+
+class AdmissionControl:
+    """
+    Limit concurrent in-flight requests per handler and per client.
+
+    Requests over a limit are rejected with a suggested retry time,
+    based on the current backlog and the average request latency.
+    Priority requests get `priority_reserve` extra slots per handler,
+    and are not limited per client.
+
+    Args:
+        handler_limit (int): max in-flight requests per handler (0 for no limit)
+        client_limit (int): max in-flight requests per client (0 for no limit)
+        priority_reserve (int): extra slots per handler for priority requests
+        latency_weight (float): weight of the newest request in the average latency
+    """
+    def __init__(self, handler_limit=0, client_limit=0, priority_reserve=0, latency_weight=0.1):
+        self.handler_limit = handler_limit
+        self.client_limit = client_limit
+        self.priority_reserve = priority_reserve
+        self.latency_weight = latency_weight
+        self.in_flight = Counter()
+        self.client_in_flight = Counter()
+        self.max_in_flight = Counter()
+        self.latency = {}
+        self.admitted = Counter()
+        self.rejected = Counter()
+
+    def retry_after(self, handler):
+        """
+        Estimate the seconds until a handler has a free slot.
+
+        Returns:
+            int: seconds, at least 1
+        """
+        concurrency = max(self.handler_limit, 1)
+        backlog = self.in_flight[handler] + 1
+        return max(1, math.ceil(backlog * self.latency.get(handler, 1.) / concurrency))
+
+    def admit(self, handler, client=None, priority=False):
+        """
+        Try to admit a request.
+
+        Args:
+            handler (str): handler name
+            client (str): client name
+            priority (bool): whether this is a priority request
+
+        Returns:
+            int: None if admitted, else seconds to wait before retrying
+        """
+        limit = self.handler_limit
+        if limit and priority:
+            limit += self.priority_reserve
+        if (limit and self.in_flight[handler] >= limit) or \
+                (client and self.client_limit and not priority and self.client_in_flight[client] >= self.client_limit):
+            self.rejected[handler] += 1
+            return self.retry_after(handler)
+
+        self.admitted[handler] += 1
+        self.in_flight[handler] += 1
+        self.max_in_flight[handler] = max(self.max_in_flight[handler], self.in_flight[handler])
+        if client:
+            self.client_in_flight[client] += 1
+        return None
+
+    def release(self, handler, client=None, duration=None):
+        """
+        Release an admitted request.
+
+        Args:
+            handler (str): handler name
+            client (str): client name
+            duration (float): seconds the request took, for the average latency
+        """
+        self.in_flight[handler] -= 1
+        if self.in_flight[handler] <= 0:
+            del self.in_flight[handler]
+        if client:
+            self.client_in_flight[client] -= 1
+            if self.client_in_flight[client] <= 0:
+                del self.client_in_flight[client]
+        if duration is not None:
+            if handler in self.latency:
+                self.latency[handler] += self.latency_weight * (duration - self.latency[handler])
+            else:
+                self.latency[handler] = duration
+
+    def get_stats(self):
+        """Get admission statistics per handler"""
+        ret = {}
+        for handler in self.admitted.keys() | self.rejected.keys():
+            ret[handler] = {
+                'in_flight': self.in_flight[handler],
+                'max_in_flight': self.max_in_flight[handler],
+                'admitted': self.admitted[handler],
+                'rejected': self.rejected[handler],
+                'latency': self.latency.get(handler, None),
+            }
+        return {
+            'handlers': ret,
+            'clients_in_flight': len(self.client_in_flight),
+        }
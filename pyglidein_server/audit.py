@@ -0,0 +1,66 @@
+import json
+import logging
+from logging.handlers import QueueListener, RotatingFileHandler
+import queue
+import random
+import time
+
+
+class AuditLog:
+    """
+    Sampled log of match decisions.
+
+    Records are queued without blocking, and written as JSON lines
+    to a rotating file by a background thread.  If the queue is full,
+    records are dropped.
+
+    Args:
+        filename (str): path of the log file
+        sample_rate (float): fraction of matches to record
+        max_bytes (int): max size of the log file before rotating
+        backup_count (int): number of rotated files to keep
+        max_queue (int): max records waiting to be written
+    """
+    def __init__(self, filename, sample_rate=1., max_bytes=10000000, backup_count=5, max_queue=10000):
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(max_queue)
+        self.records = 0
+        self.dropped = 0
+
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.listener = QueueListener(self.queue, handler)
+        self.listener.start()
+
+    def sample(self):
+        """Decide whether to record the next match"""
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, **fields):
+        """
+        Queue a record to be written.
+
+        Args:
+            **fields: record contents, which must be json serializable
+        """
+        fields['time'] = time.time()
+        record = logging.makeLogRecord({'msg': json.dumps(fields, separators=(',', ':'))})
+        try:
+            self.queue.put_nowait(record)
+            self.records += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write all queued records and stop the background thread"""
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def get_stats(self):
+        """Get audit log statistics"""
+        return {
+            'sample_rate': self.sample_rate,
+            'records': self.records,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import hashlib
+import time
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of verified token claims.
+
+    Tokens are keyed by their digest, so the cache does not hold the
+    tokens themselves.  An entry is valid until the token expires or
+    `max_age` seconds pass, whichever is first.
+
+    Args:
+        size (int): max number of tokens to cache
+        max_age (float): max seconds to trust a cached verification
+    """
+    def __init__(self, size=10000, max_age=300):
+        self.size = size
+        self.max_age = max_age
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    @staticmethod
+    def key(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, token, now=None):
+        """
+        Get the verified claims for a token.
+
+        Args:
+            token (str): token
+            now (float): current time (default: time.time())
+
+        Returns:
+            dict: token claims, or None if not cached
+        """
+        if now is None:
+            now = time.time()
+        key = self.key(token)
+        entry = self.data.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        expiration, claims = entry
+        if expiration <= now:
+            del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return claims
+
+    def put(self, token, claims, now=None):
+        """
+        Cache the verified claims for a token.
+
+        Args:
+            token (str): token
+            claims (dict): verified token claims
+            now (float): current time (default: time.time())
+        """
+        if self.size <= 0:
+            return
+        if now is None:
+            now = time.time()
+        expiration = now + self.max_age
+        if 'exp' in claims:
+            expiration = min(expiration, claims['exp'])
+        key = self.key(token)
+        self.data[key] = (expiration, claims)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def flush(self):
+        """Remove all cached tokens, such as after changing the auth secret"""
+        self.data.clear()
+        self.flushes += 1
+
+    def get_stats(self):
+        """Get cache statistics"""
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+        }
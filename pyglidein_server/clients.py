@@ -1,6 +1,8 @@
 from copy import deepcopy
+import heapq
 import math
 import logging
+import time
 
 from .resources import Resources
 from .util import Error
@@ -14,9 +16,96 @@ class Clients:
 
     Each client may have N resource queues. Lookups are by `Resources`,
     specifically separating queued and processing resources.
+
+    Glidein counts are also summed over all clients per `Resources`,
+    so matching does not have to scan every client.
+
+    Clients that have not been seen for `ttl` seconds are evicted.
+
+    Match decisions are recorded to the `audit` log, if sampled.
+
+    Args:
+        ttl (float): seconds before an idle client is evicted (default: never)
+        audit (AuditLog): match decision log (default: none)
     """
-    def __init__(self):
+    QUEUE_KEYS = {'resources', 'num_queued', 'num_processing'}
+
+    def __init__(self, ttl=None, audit=None):
         self.data = {}
+        self.refs = {}
+        self.totals = {}
+        self.listeners = []
+        self.ttl = ttl
+        self.last_seen = {}
+        self.expiry = []  # heap of (expiration time, name), may have old entries
+        self.evictions = 0
+        self.audit = audit
+
+    def add_listener(self, callback):
+        """
+        Add a callback for whenever client data changes.
+
+        Args:
+            callback (callable): called with the names of the changed clients
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, names):
+        for callback in self.listeners:
+            callback(names)
+
+    def _touch(self, name):
+        """Mark a client as seen"""
+        if not self.ttl:
+            return
+        now = time.time()
+        self.last_seen[name] = now
+        heapq.heappush(self.expiry, (now + self.ttl, name))
+        if len(self.expiry) > 2 * len(self.last_seen) + 100:
+            # drop old entries for clients that were seen again
+            self.expiry = [(t, n) for t, n in self.expiry if n in self.last_seen and self.last_seen[n] + self.ttl == t]
+            heapq.heapify(self.expiry)
+
+    def expire(self, now=None):
+        """
+        Evict clients that have not been seen within the ttl.
+
+        Args:
+            now (float): current time (default: time.time())
+
+        Returns:
+            list: names of evicted clients
+        """
+        if not self.ttl:
+            return []
+        if now is None:
+            now = time.time()
+        evicted = []
+        while self.expiry and self.expiry[0][0] <= now:
+            t, name = heapq.heappop(self.expiry)
+            if name not in self.last_seen or self.last_seen[name] + self.ttl != t:
+                continue  # seen again since this entry
+            for res, queue in self.data.pop(name, {}).items():
+                self._remove_totals(res, queue)
+            self.refs.pop(name, None)
+            del self.last_seen[name]
+            evicted.append(name)
+        if evicted:
+            self.evictions += len(evicted)
+            logger.info(f'evicted clients: {evicted}')
+            self._notify(evicted)
+        return evicted
+
+    def get_stats(self):
+        """Get client table statistics"""
+        ret = {
+            'clients': len(self.data),
+            'ttl': self.ttl,
+            'evictions': self.evictions,
+        }
+        if self.audit:
+            ret['audit'] = self.audit.get_stats()
+        return ret
 
     def update(self, name, queues):
         """
@@ -31,6 +120,102 @@ class Clients:
             name (str): name of client
             queues (dict): queue information
         """
+        self.expire()
+        self._set(name, self._parse(queues))
+        self._notify([name])
+
+    def update_many(self, clients):
+        """
+        Update several clients at once.
+
+        All clients are validated before any are updated.
+
+        Args:
+            clients (dict): client name to queue information
+        """
+        if not isinstance(clients, dict):
+            raise Error('clients must be a dict of client queue statuses')
+        self.expire()
+        parsed = {name: self._parse(clients[name]) for name in clients}
+        for name in parsed:
+            self._set(name, parsed[name])
+        self._notify(list(parsed))
+
+    def patch(self, name, queues):
+        """
+        Partially update a client.
+
+        Only the queues that changed need to be sent, keyed by their ref.
+        Existing queues may send any subset of `resources`, `num_queued`,
+        and `num_processing`. New queues must send all of them.  A queue
+        of `None` removes that queue.
+
+        Unchanged queues keep their existing `Resources`.  Unknown
+        clients, such as ones that were evicted, must send a full update.
+
+        Args:
+            name (str): name of client
+            queues (dict): changed queue information
+        """
+        if not isinstance(queues, dict):
+            raise Error('client data must be a dict of queue statuses')
+        self.expire()
+
+        if name not in self.data:
+            raise Error(f'unknown client {name}, send a full update')
+        data = self.data[name]
+        refs = self.refs[name]
+
+        # validate everything before changing anything
+        changes = []
+        for ref in queues:
+            queue = queues[ref]
+            if queue is None:
+                changes.append((ref, None, None))
+                continue
+            if not isinstance(queue, dict) or set(queue.keys()) - self.QUEUE_KEYS:
+                raise Error('client data must have keys: resources, num_queued, num_processing')
+            if ref not in refs and set(queue.keys()) != self.QUEUE_KEYS:
+                raise Error(f'new client queue {ref} must have keys: resources, num_queued, num_processing')
+            if 'resources' in queue:
+                if set(queue['resources']) - set(Resources.RESOURCE_DEFAULTS):
+                    raise Error(f'client data resources must be: {set(Resources.RESOURCE_DEFAULTS)}')
+                res = Resources(queue['resources'], tolerance=1)
+            else:
+                res = refs[ref]
+            changes.append((ref, res, queue))
+
+        for ref, res, queue in changes:
+            old = None
+            if ref in refs:
+                old_res = refs.pop(ref)
+                old = data.pop(old_res)
+                self._remove_totals(old_res, old)
+            if queue is None or (old is None and set(queue.keys()) != self.QUEUE_KEYS):
+                # removed, or replaced earlier in this patch by a queue with the same resources
+                continue
+            if res in data:
+                # another queue binned to the same resources, so replace it
+                other = data.pop(res)
+                del refs[other['ref']]
+                self._remove_totals(res, other)
+            new = {
+                'ref': ref,
+                'num_queued': queue['num_queued'] if 'num_queued' in queue else old['num_queued'],
+                'num_processing': queue['num_processing'] if 'num_processing' in queue else old['num_processing'],
+            }
+            data[res] = new
+            refs[ref] = res
+            self._add_totals(res, new)
+
+        self.data[name] = data
+        self.refs[name] = refs
+        self._touch(name)
+        self._notify([name])
+
+    @classmethod
+    def _parse(cls, queues):
+        """Validate queue information and bin the resources"""
         if not isinstance(queues, dict):
             raise Error('client data must be a dict of queue statuses')
 
@@ -38,7 +223,7 @@ class Clients:
         for ref in queues:
             queue = queues[ref]
             # validate
-            if set(queue.keys()) != {'resources', 'num_queued', 'num_processing'}:
+            if set(queue.keys()) != cls.QUEUE_KEYS:
                 raise Error('client data must have keys: resources, num_queued, num_processing')
             if set(queue['resources']) - set(Resources.RESOURCE_DEFAULTS):
                 raise Error(f'client data resources must be: {set(Resources.RESOURCE_DEFAULTS)}')
@@ -49,20 +234,50 @@ class Clients:
                 'num_queued': queue['num_queued'],
                 'num_processing': queue['num_processing'],
             }
+        return ret
 
-        # do update
-        self.data[name] = ret
+    def _set(self, name, queues):
+        """Replace a client's queues"""
+        for res, queue in self.data.get(name, {}).items():
+            self._remove_totals(res, queue)
+        self.data[name] = queues
+        self.refs[name] = {queues[res]['ref']: res for res in queues}
+        self._touch(name)
+        for res, queue in queues.items():
+            self._add_totals(res, queue)
+
+    def _add_totals(self, res, queue):
+        """Add a queue to the global glidein totals"""
+        if res not in self.totals:
+            self.totals[res] = {'num_queued': 0, 'num_processing': 0, 'queues': 0}
+        totals = self.totals[res]
+        totals['num_queued'] += queue['num_queued']
+        totals['num_processing'] += queue['num_processing']
+        totals['queues'] += 1
+
+    def _remove_totals(self, res, queue):
+        """Remove a queue from the global glidein totals"""
+        totals = self.totals[res]
+        totals['queues'] -= 1
+        if totals['queues'] <= 0:
+            del self.totals[res]
+        else:
+            totals['num_queued'] -= queue['num_queued']
+            totals['num_processing'] -= queue['num_processing']
 
     def get(self, name):
         """Get client data"""
+        self.expire()
         return self.data[name]
 
     def get_all(self):
         """Get all client data"""
+        self.expire()
         return self.data
 
     def get_json(self):
         """Get client data in json format"""
+        self.expire()
         ret = {}
         for k in self.data:
             r = {}
@@ -87,11 +302,48 @@ class Clients:
         Returns:
             dict: name of queue and number of jobs to submit
         """
+        self.expire()
+        self._touch(name)
+        return self._match(name, condor_queue.get())
+
+    def match_many(self, names, condor_queue):
+        """
+        Perform matching for several clients.
+
+        All clients are matched against the same condor queue snapshot.
+
+        Args:
+            names (iterable): names of clients
+            condor_queue (CondorCache): condor queue
+
+        Returns:
+            dict: name of client to a dict of name of queue and number of jobs to submit
+        """
+        self.expire()
         condor_jobs = condor_queue.get()
+        ret = {}
+        for name in names:
+            self._touch(name)
+            ret[name] = self._match(name, condor_jobs)
+        return ret
+
+    def _match(self, name, condor_jobs, planned=None):
+        """
+        Match a client against a condor queue snapshot.
 
+        Args:
+            name (str): name of client
+            condor_jobs (Mapping): condor queue snapshot
+            planned (dict): `Resources` to glideins already allocated, counted as queued
+
+        Returns:
+            dict: name of queue and number of jobs to submit
+        """
+        queues = self.data[name]
+        audit = self.audit is not None and self.audit.sample()
         ret = {}
-        for res in self.data[name]:
-            queue = self.data[name][res]
+        for res in queues:
+            queue = queues[res]
 
             jobs_queued = 0.
             jobs_processing = 0.
@@ -106,36 +358,44 @@ class Clients:
             else:
                 job_ratio = 1.
 
-            logger.debug(f'jobs_queued: {jobs_queued}')
-            logger.debug(f'jobs_processing: {jobs_processing}')
-            logger.debug(f'job_ratio: {job_ratio}')
-
             glideins_queued = 0.
             glideins_processing = 0.
-            for site in self.data:
-                for r in self.data[site]:
+            for r in self.totals:
+                if r <= res:
+                    mismatch = res.mismatch(r)
+                    glideins_queued += mismatch * self.totals[r]['num_queued']
+                    glideins_processing += mismatch * self.totals[r]['num_processing']
+            if planned:
+                for r in planned:
                     if r <= res:
-                        mismatch = res.mismatch(r)
-                        glideins_queued += mismatch * self.data[site][r]['num_queued']
-                        glideins_processing += mismatch * self.data[site][r]['num_processing']
+                        glideins_queued += res.mismatch(r) * planned[r]
 
             if glideins_processing > 0:
                 glidein_util = glideins_processing / (glideins_processing + glideins_queued)
             else:
                 glidein_util = 1.
 
-            logger.debug(f'glideins_queued: {glideins_queued}')
-            logger.debug(f'glideins_processing: {glideins_processing}')
-            logger.debug(f'glidein_util: {glidein_util}')
-
             global_queue = (jobs_queued - glideins_queued) * math.pow(job_ratio, 1/4) * math.pow(glidein_util, 2)
-
-            logger.debug(f'global_queue: {global_queue}')
-
             local_queue = max(global_queue - queue['num_queued'], 0)
-            logger.debug(f'local_queue: {local_queue}')
 
             if local_queue > 0:
                 ret[queue['ref']] = math.ceil(local_queue)
 
+            if audit:
+                self.audit.record(
+                    client=name,
+                    queue=queue['ref'],
+                    resources=res.resources,
+                    jobs_queued=jobs_queued,
+                    jobs_processing=jobs_processing,
+                    job_ratio=job_ratio,
+                    glideins_queued=glideins_queued,
+                    glideins_processing=glideins_processing,
+                    glidein_util=glidein_util,
+                    global_queue=global_queue,
+                    local_queue=local_queue,
+                    num_queued=queue['num_queued'],
+                    result=ret.get(queue['ref'], 0),
+                )
+
         return ret
@@ -1,16 +1,39 @@
-from collections import defaultdict
-from copy import deepcopy
+import abc
+from array import array
+import asyncio
+from collections import deque
+from collections.abc import Mapping, MutableMapping
 from functools import partial
+import logging
 import subprocess
 import time
 
 import htcondor
-# import classad
+import classad
 
 from .resources import Resources
 
+logger = logging.getLogger(__name__)
+
 
 class CondorCache:
+    """
+    Cache of job counts from the HTCondor queue.
+
+    The cache is a snapshot that is replaced on each refresh, so callers
+    must treat it as read-only.
+
+    Refreshing runs as a pipeline over the schedd query results.
+    `refresh` runs the query and counting in an executor thread, since
+    the HTCondor bindings block, and publishes the new snapshot in the
+    event loop.
+
+    Schedds are located through the collector every `schedd_timeout`
+    seconds, and their handles are reused between refreshes.
+
+    With `lazy`, the first refresh is left to the caller, and the cache
+    is empty until then.
+    """
     CONDOR_CLASSADS = [
         'JobStatus', 'SingularityImage',
         'RequestCPUs', 'RequestGPUs', 'RequestMemory',
@@ -18,13 +41,50 @@ class CondorCache:
         'MachineAttrGLIDEIN_Site0', 'MachineAttrGLIDEIN_ResourceName0',
     ]
 
-    def __init__(self, collector_address='localhost', cache_timeout=60):
+    # JobStatus code to status name
+    JOB_STATUS = {
+        int(htcondor.JobStatus.IDLE): 'queued',
+        int(htcondor.JobStatus.RUNNING): 'processing',
+    }
+
+    def __init__(self, collector_address='localhost', cache_timeout=60,
+                 min_cache_timeout=None, max_cache_timeout=None, max_refresh_share=1.,
+                 schedd_timeout=600, lazy=False):
         self.collector_address = collector_address
-        self.cache = {}
+        self.schedds = {}
+        self.schedds_age = -1
+        self.schedd_timeout = schedd_timeout
+        self.cache = JobCountsTable()
+        self.cache_json = None
         self.cache_age = -1
-        self.cache_timeout = cache_timeout
+        self.refresh_task = None
+        self.scheduler = RefreshScheduler(cache_timeout, min_timeout=min_cache_timeout,
+                                          max_timeout=max_cache_timeout,
+                                          max_share=max_refresh_share)
+        self.cache_timeout = self.scheduler.timeout
+        self.listeners = []
+
+        if not lazy:
+            self._refresh_cache()
+
+    @property
+    def ready(self):
+        """Whether the first snapshot has been loaded"""
+        return self.cache_age >= 0
+
+    @property
+    def stale(self):
+        """Whether the cache is due for a refresh"""
+        return self.cache_age + self.cache_timeout < time.time()
 
-        self._refresh_cache()
+    def add_listener(self, callback):
+        """
+        Add a callback for whenever the cache is refreshed.
+
+        Args:
+            callback (callable): called with the CondorCache
+        """
+        self.listeners.append(callback)
 
     @classmethod
     def convert_classads(cls, ads):
@@ -36,54 +96,164 @@ class CondorCache:
                 ret[k] = ads[k]
         return ret
 
-    def _refresh_cache(self):
-        """Ask HTcondor about the jobs on the queue"""
+    @classmethod
+    def extract_job(cls, ad):
+        """
+        Extract the `CONDOR_CLASSADS` projection from a job ad.
+
+        Only expressions are evaluated.  Undefined and error values
+        are returned as None.
+
+        Args:
+            ad (classad.ClassAd): job ad
+
+        Returns:
+            tuple: (RequestCPUs, RequestGPUs, RequestMemory, RequestDisk,
+                    OriginalTime, SingularityImage, site, resource, status)
+        """
+        def get(k):
+            v = ad.get(k, None)
+            if isinstance(v, classad.ExprTree):
+                try:
+                    v = ad.eval(k)
+                except TypeError:
+                    return None
+            if isinstance(v, classad.Value):
+                return None
+            return v
+
+        status = get('JobStatus')
+        return (
+            get('RequestCPUs'),
+            get('RequestGPUs'),
+            get('RequestMemory'),
+            get('RequestDisk'),
+            get('OriginalTime'),
+            get('SingularityImage'),
+            get('MachineAttrGLIDEIN_Site0'),
+            get('MachineAttrGLIDEIN_ResourceName0'),
+            cls.JOB_STATUS.get(1 if status is None else status, 'unknown'),
+        )
+
+    def get_schedds(self):
+        """
+        Get handles for the schedds in the pool.
+
+        Schedds are located again once the list is older than
+        `schedd_timeout`.  If that fails, the last known list is used.
+
+        Returns:
+            list: htcondor.Schedd objects
+        """
+        if self.schedds_age + self.schedd_timeout < time.time():
+            try:
+                coll_query = htcondor.Collector(self.collector_address).locateAll(htcondor.DaemonTypes.Schedd)
+            except Exception:
+                if not self.schedds:
+                    raise
+                logger.warning('failed to locate schedds, using last known list', exc_info=True)
+            else:
+                schedds = {}
+                for schedd_ad in coll_query:
+                    key = (schedd_ad.get('Name', None), schedd_ad.get('MyAddress', None))
+                    schedds[key] = self.schedds[key] if key in self.schedds else htcondor.Schedd(schedd_ad)
+                self.schedds = schedds
+                self.schedds_age = time.time()
+        return list(self.schedds.values())
+
+    def _query_ads(self):
+        """Ask the schedds for job ads, yielding them as they arrive"""
         queries = []
-        coll_query = htcondor.Collector(self.collector_address).locateAll(htcondor.DaemonTypes.Schedd)
-        for schedd_ad in coll_query:
-            schedd_obj = htcondor.Schedd(schedd_ad)
-            queries.append(schedd_obj.xquery(projection=CondorCache.CONDOR_CLASSADS))
+        for schedd_obj in self.get_schedds():
+            try:
+                queries.append(schedd_obj.xquery(projection=CondorCache.CONDOR_CLASSADS))
+            except Exception:
+                # the schedd may have moved, so locate them again next time
+                self.schedds_age = -1
+                raise
 
-        job_counts = defaultdict(JobCounts)
         for query in htcondor.poll(queries):
-            jobs = query.nextAdsNonBlocking()
-            for job in jobs:
-                ads = self.convert_classads(job)
-
-                site = ads.get('MachineAttrGLIDEIN_Site0', None)
-                resource = ads.get('MachineAttrGLIDEIN_ResourceName0', None)
-                status = htcondor.JobStatus(ads.get('JobStatus', 1))
-                if status == htcondor.JobStatus.IDLE:
-                    status = 'queued'
-                elif status == htcondor.JobStatus.RUNNING:
-                    status = 'processing'
-                else:
-                    status = 'unknown'
-
-                res = Resources.from_condor(ads)
-                job_counts[res][site][resource][status] += 1
-                job_counts[res]['_sum'][status] += 1
+            yield from query.nextAdsNonBlocking()
+
+    def _count_jobs(self):
+        """
+        Ask HTCondor about the jobs on the queue, without publishing.
 
+        Returns:
+            tuple: (JobCountsTable, seconds it took)
+        """
+        start = time.time()
+        job_counts = JobCountsTable()
+        rows = map(self.extract_job, self._query_ads())
+        for cpu, gpu, memory, disk, walltime, singularity, site, resource, status in rows:
+            res = Resources.from_condor_row(cpu, gpu, memory, disk, walltime, singularity)
+            job_counts.add(res, site, resource, status)
+        job_counts.freeze()
+        return job_counts, time.time() - start
+
+    def _publish(self, job_counts, duration):
+        """Replace the cache with a new snapshot"""
         self.cache = job_counts
+        self.cache_json = None
         self.cache_age = time.time()
+        self.cache_timeout = self.scheduler.update(job_counts, duration)
+
+        for callback in self.listeners:
+            callback(self)
+
+    def _refresh_cache(self):
+        """Ask HTcondor about the jobs on the queue"""
+        self._publish(*self._count_jobs())
+
+    async def _refresh_async(self):
+        job_counts, duration = await asyncio.get_running_loop().run_in_executor(None, self._count_jobs)
+        self._publish(job_counts, duration)
+
+    async def refresh(self, force=False):
+        """
+        Refresh the cache in an executor thread, if it is stale.
+
+        Concurrent callers share the same refresh.  Cancelling the
+        caller does not stop the refresh, which still publishes when done.
+
+        Args:
+            force (bool): refresh even if the cache is not stale
+        """
+        if not self.refresh_task:
+            if not force and not self.stale:
+                return
+            self.refresh_task = asyncio.ensure_future(self._refresh_async())
+            self.refresh_task.add_done_callback(self._refresh_done)
+        await asyncio.shield(self.refresh_task)
+
+    def _refresh_done(self, task):
+        self.refresh_task = None
 
     def get(self):
-        if self.cache_age + self.cache_timeout < time.time():
+        if self.stale:
             self._refresh_cache()
 
         return self.get_cached()
 
     def get_cached(self):
-        return deepcopy(self.cache)
+        """Get the current cache, which must not be modified"""
+        return self.cache
 
     def get_json(self):
         """Get json version of job cache"""
-        ret = {}
-        for res in self.cache:
-            key = hash(res)
-            ret[key] = deepcopy(self.cache[res])
-            ret[key]['_resources'] = res.resources
-        return ret
+        if self.cache_json is None:
+            self.cache_json = self.cache.to_json()
+        return self.cache_json
+
+    def get_stats(self):
+        """Get cache refresh statistics"""
+        return {
+            'cache_age': self.cache_age,
+            'cache_timeout': self.cache_timeout,
+            'refreshes': list(self.scheduler.history),
+            'schedds': len(self.schedds),
+            'schedds_age': self.schedds_age,
+        }
 
     def get_startd_token(self):
         """Get an HTCondor auth token"""
@@ -93,21 +263,625 @@ class CondorCache:
         return out.strip()
 
 
-class JobCounts(dict):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self['_sum'] = defaultdict(int)
+class CondorPools:
+    """
+    Combined job counts from several HTCondor pools.
+
+    Each pool has its own `CondorCache`, refreshed on its own schedule.
+    Pools are refreshed concurrently in executor threads, and a failed
+    or timed out pool keeps its last snapshot.  Job counts are merged into one
+    snapshot, with per-pool counts in `get_json`.
+
+    Args:
+        collector_addresses (list): collector address of each pool
+        pool_timeout (float): max seconds for an async pool refresh (default: no limit)
+        **kwargs: arguments for each `CondorCache`
+    """
+    def __init__(self, collector_addresses=('localhost',), pool_timeout=None, **kwargs):
+        if not collector_addresses:
+            raise Exception('need at least one collector address')
+        self.pool_timeout = pool_timeout
+        self.listeners = []
+        self.cache = None
+        self.cache_json = None
+        self.pool_counts = {}
+        self.health = {}
+        self.pools = {}
+        self.warm_up_task = None
+        self.refresh_tasks = {}  # address to running refresh
+        for address in collector_addresses:
+            self.health[address] = {'ok': True, 'failures': 0, 'error': None}
+            self.pools[address] = CondorCache(address, **kwargs)
+            self.pools[address].add_listener(partial(self._pool_refreshed, address))
+
+    def add_listener(self, callback):
+        """
+        Add a callback for whenever any pool is refreshed.
+
+        Args:
+            callback (callable): called with the CondorPools
+        """
+        self.listeners.append(callback)
+
+    def _pool_refreshed(self, address, pool):
+        self.health[address].update(ok=True, failures=0, error=None)
+        self.cache = None
+        self.cache_json = None
+        for callback in self.listeners:
+            callback(self)
+
+    def _pool_failed(self, address, e):
+        logger.warning(f'failed to refresh pool {address}', exc_info=True)
+        health = self.health[address]
+        health['ok'] = False
+        health['failures'] += 1
+        health['error'] = str(e) or repr(e)
+
+    @property
+    def ready(self):
+        """
+        Whether the first refresh of every pool is done.
+
+        A pool that failed its first refresh does not block readiness,
+        as long as some pool has a snapshot.
+        """
+        return any(pool.ready for pool in self.pools.values()) and all(
+            pool.ready or self.health[address]['failures']
+            for address, pool in self.pools.items()
+        )
+
+    @property
+    def cache_age(self):
+        return min(pool.cache_age for pool in self.pools.values())
+
+    @property
+    def cache_timeout(self):
+        return min(pool.cache_timeout for pool in self.pools.values())
+
+    async def _refresh_pool(self, address, force):
+        try:
+            await asyncio.wait_for(self.pools[address].refresh(force=force), self.pool_timeout)
+        except Exception as e:
+            self._pool_failed(address, e)
+
+    def _refresh_done(self, address, task):
+        del self.refresh_tasks[address]
+
+    async def refresh(self, force=False, background=False):
+        """
+        Refresh stale pools concurrently.
+
+        Each pool has at most one refresh running, shared by all callers.
+        With `background`, this only waits while there is no snapshot
+        yet, so callers serve the current snapshot during a slow refresh.
+
+        Args:
+            force (bool): refresh even if the pools are not stale
+            background (bool): do not wait if there is a snapshot
+        """
+        for address, pool in self.pools.items():
+            if address not in self.refresh_tasks and (force or pool.stale):
+                task = asyncio.ensure_future(self._refresh_pool(address, force))
+                self.refresh_tasks[address] = task
+                task.add_done_callback(partial(self._refresh_done, address))
+        if background and self.ready:
+            return
+        await asyncio.gather(*(asyncio.shield(task) for task in list(self.refresh_tasks.values())))
+
+    def warm_up(self, retry_delay=1, max_retry_delay=60):
+        """
+        Start the first refresh of every pool in the background.
+
+        Pools without a snapshot are retried with exponential backoff
+        until `ready`, so failing pools at startup do not leave the
+        server unready.
+
+        Args:
+            retry_delay (float): seconds before the first retry
+            max_retry_delay (float): max seconds between retries
+
+        Returns:
+            asyncio.Future: the warm up
+        """
+        self.warm_up_task = asyncio.ensure_future(self._warm_up(retry_delay, max_retry_delay))
+        return self.warm_up_task
+
+    async def _warm_up(self, retry_delay, max_retry_delay):
+        await self.refresh(force=True)
+        while not self.ready:
+            logger.info(f'condor pools not ready, retrying in {retry_delay}s')
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, max_retry_delay)
+            await asyncio.gather(*(self._refresh_pool(address, True)
+                                   for address, pool in self.pools.items() if not pool.ready))
+
+    def get(self):
+        """
+        Get the merged cache, which must not be modified.
+
+        Pools are only refreshed by `refresh`, so this never blocks.
+        """
+        return self.get_cached()
+
+    def get_cached(self):
+        """Get the merged cache, which must not be modified"""
+        if self.cache is None:
+            job_counts = JobCountsTable()
+            pool_counts = {}
+            for address, pool in self.pools.items():
+                cache = pool.get_cached()
+                job_counts.merge(cache)
+                for res in cache:
+                    pool_counts.setdefault(res, {})[address] = dict(cache[res]['_sum'])
+            job_counts.freeze()
+            self.cache = job_counts
+            self.pool_counts = pool_counts
+        return self.cache
+
+    def get_json(self):
+        """Get json version of the merged job cache, with per-pool counts"""
+        if self.cache_json is None:
+            cache = self.get_cached()
+            ret = cache.to_json()
+            for res in cache:
+                ret[hash(res)]['_pools'] = self.pool_counts[res]
+            self.cache_json = ret
+        return self.cache_json
+
+    def get_stats(self):
+        """Get refresh statistics and health of each pool"""
+        pools = {}
+        for address, pool in self.pools.items():
+            pools[address] = pool.get_stats()
+            pools[address].update(self.health[address])
+        return {
+            'cache_timeout': self.cache_timeout,
+            'pools': pools,
+        }
+
+    def pool_for(self, resources):
+        """
+        Pick the pool with the most queued jobs that fit any of the resources.
+
+        Args:
+            resources (iterable): `Resources` of the queues being provisioned
+
+        Returns:
+            str: collector address of the pool
+        """
+        cache = self.get_cached()
+        demand = {address: 0 for address in self.pools}
+        for res in resources:
+            for r in cache:
+                if r <= res:
+                    for address, counts in self.pool_counts[r].items():
+                        demand[address] += counts.get('queued', 0)
+        return max(demand, key=demand.get)
+
+    def get_startd_token(self, pool=None):
+        """
+        Get an HTCondor auth token for a pool.
+
+        Args:
+            pool (str): collector address (default: the first pool)
+        """
+        if pool is None:
+            pool = next(iter(self.pools))
+        return self.pools[pool].get_startd_token()
+
+
+class RefreshScheduler:
+    """
+    Pick the time until the next condor cache refresh.
+
+    Refreshes come sooner while the per-bin job counts are changing,
+    and later while they are static.  The interval stays within
+    `min_timeout` and `max_timeout`, except that it is always long
+    enough for refreshing to take at most `max_share` of wall time.
+
+    Args:
+        timeout (float): initial seconds between refreshes
+        min_timeout (float): minimum seconds between refreshes (default: timeout)
+        max_timeout (float): maximum seconds between refreshes (default: timeout)
+        max_share (float): maximum fraction of wall time spent refreshing (default: 1)
+        history (int): number of recent refreshes to keep stats for
+    """
+    # relative change in job counts to refresh faster / slower
+    HIGH_CHURN = 0.1
+    LOW_CHURN = 0.01
+    SPEEDUP = 0.5
+    SLOWDOWN = 1.5
+
+    def __init__(self, timeout=60, min_timeout=None, max_timeout=None, max_share=1., history=10):
+        self.min_timeout = timeout if min_timeout is None else min_timeout
+        self.max_timeout = timeout if max_timeout is None else max_timeout
+        if self.min_timeout > self.max_timeout:
+            raise Exception('min_timeout must be <= max_timeout')
+        if not 0 < max_share <= 1:
+            raise Exception('max_share must be in (0, 1]')
+        self.max_share = max_share
+        self.timeout = min(max(timeout, self.min_timeout), self.max_timeout)
+        self.counts = None
+        self.history = deque(maxlen=history)
+
+    @staticmethod
+    def job_counts(cache):
+        """Get the queued and processing counts per bin"""
+        ret = {}
+        for res in cache:
+            s = cache[res]['_sum']
+            ret[res] = (s.get('queued', 0), s.get('processing', 0))
+        return ret
+
+    @staticmethod
+    def churn(old, new):
+        """Get the change between two sets of counts, relative to the total"""
+        change = 0
+        total = 0
+        for res in old.keys() | new.keys():
+            a = old.get(res, (0, 0))
+            b = new.get(res, (0, 0))
+            change += abs(a[0] - b[0]) + abs(a[1] - b[1])
+            total += max(a[0], b[0]) + max(a[1], b[1])
+        return change / total if total else 0.
+
+    def update(self, cache, duration):
+        """
+        Update the interval after a refresh.
+
+        Args:
+            cache (dict): the new job cache
+            duration (float): seconds the refresh took
+
+        Returns:
+            float: seconds until the next refresh
+        """
+        counts = self.job_counts(cache)
+        churn = None
+        if self.counts is not None:
+            churn = self.churn(self.counts, counts)
+            if churn >= self.HIGH_CHURN:
+                self.timeout *= self.SPEEDUP
+            elif churn <= self.LOW_CHURN:
+                self.timeout *= self.SLOWDOWN
+        self.counts = counts
+
+        self.timeout = min(max(self.timeout, self.min_timeout), self.max_timeout)
+        # refresh work / wall time = duration / (duration + timeout) <= max_share
+        self.timeout = max(self.timeout, duration * (1 / self.max_share - 1))
+
+        self.history.append({
+            'time': time.time(),
+            'duration': duration,
+            'churn': churn,
+            'timeout': self.timeout,
+        })
+        return self.timeout
+
+
+class Interner:
+    """Map values to small ints, in order of first appearance"""
+    def __init__(self, values=()):
+        self.ids = {}
+        self.values = []
+        for v in values:
+            self.intern(v)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, value):
+        return self.ids.get(value, None)
+
+    def intern(self, value):
+        i = self.ids.get(value, None)
+        if i is None:
+            i = len(self.values)
+            self.ids[value] = i
+            self.values.append(value)
+        return i
+
+
+def _zeros(typecode, n):
+    return array(typecode, bytes(array(typecode).itemsize * n))
+
+
+class JobCountsTable(Mapping):
+    """
+    Columnar job counts for a condor queue snapshot.
+
+    Bins (`Resources`), sites, resource names, and statuses are interned
+    to small ints.  Each (bin, site, resource name) is a row, with a
+    count column per status.  Per-bin sums have their own columns.
+
+    The row index is only needed while counting, so `freeze` drops it
+    once the snapshot is complete.  Lookups then scan the rows of a bin.
+
+    Indexing by bin gives a `JobCounts` view, so the nested access
+    `table[res][site][resource][status]` and `table[res]['_sum'][status]`
+    still works.  Indexing a missing bin raises `KeyError`, so reads
+    never change a published snapshot.  Use `add` to count jobs.
+    """
+    STATUSES = ('queued', 'processing', 'unknown')
+
+    def __init__(self):
+        self.bins = Interner()
+        self.sites = Interner()
+        self.resource_names = Interner()
+        self.statuses = Interner(self.STATUSES)
+        self.rows = {}  # (bin, site, resource) ids -> row
+        self.row_bin = array('i')
+        self.row_site = array('i')
+        self.row_resource = array('i')
+        self.bin_rows = []  # rows of each bin
+        self.counts = [array('i') for _ in self.statuses.values]  # [status][row]
+        self.sums = [array('q') for _ in self.statuses.values]  # [status][bin]
+
+    def freeze(self):
+        """Drop the row index, to save memory once counting is done"""
+        self.rows = None
+
+    def _bin(self, res):
+        b = self.bins.intern(res)
+        if b == len(self.bin_rows):
+            self.bin_rows.append(array('i'))
+            for col in self.sums:
+                col.append(0)
+        return b
+
+    def _status(self, status):
+        s = self.statuses.intern(status)
+        if s == len(self.counts):
+            self.counts.append(_zeros('i', len(self.row_bin)))
+            self.sums.append(_zeros('q', len(self.bin_rows)))
+        return s
+
+    def _row(self, b, site, resource):
+        if self.rows is None:
+            self.rows = {k: row for row, k in enumerate(zip(self.row_bin, self.row_site, self.row_resource))}
+        key = (b, self.sites.intern(site), self.resource_names.intern(resource))
+        row = self.rows.get(key, None)
+        if row is None:
+            row = len(self.row_bin)
+            self.rows[key] = row
+            self.row_bin.append(key[0])
+            self.row_site.append(key[1])
+            self.row_resource.append(key[2])
+            self.bin_rows[b].append(row)
+            for col in self.counts:
+                col.append(0)
+        return row
+
+    def _find_row(self, b, site, resource):
+        site_id = self.sites.get(site)
+        resource_id = self.resource_names.get(resource)
+        if site_id is None or resource_id is None:
+            return None
+        if self.rows is not None:
+            return self.rows.get((b, site_id, resource_id), None)
+        for row in self.bin_rows[b]:
+            if self.row_site[row] == site_id and self.row_resource[row] == resource_id:
+                return row
+        return None
+
+    def add(self, res, site, resource, status, n=1):
+        """
+        Count jobs for a bin, site, and resource name, including the bin sum.
+
+        Args:
+            res (Resources): resource bin
+            site (str): glidein site
+            resource (str): glidein resource name
+            status (str): job status
+            n (int): number of jobs
+        """
+        b = self._bin(res)
+        s = self._status(status)
+        self.counts[s][self._row(b, site, resource)] += n
+        self.sums[s][b] += n
+
+    def merge(self, other):
+        """
+        Add all counts from another table.
+
+        Args:
+            other (JobCountsTable): counts to add
+        """
+        statuses = [self._status(status) for status in other.statuses.values]
+        bins = [self._bin(res) for res in other.bins.values]
+        sites = other.sites.values
+        names = other.resource_names.values
+        for row in range(len(other.row_bin)):
+            r = self._row(bins[other.row_bin[row]], sites[other.row_site[row]], names[other.row_resource[row]])
+            for s, col in zip(statuses, other.counts):
+                self.counts[s][r] += col[row]
+        for s, col in zip(statuses, other.sums):
+            for b, n in enumerate(col):
+                self.sums[s][bins[b]] += n
+
+    def to_json(self):
+        """Get a json-able dict of counts, keyed by bin hash"""
+        ret = {}
+        for b, res in enumerate(self.bins.values):
+            ret[hash(res)] = JobCounts(self, b).to_dict()
+            ret[hash(res)]['_resources'] = res.resources
+        return ret
+
+    def __getitem__(self, res):
+        b = self.bins.get(res)
+        if b is None:
+            raise KeyError(res)
+        return JobCounts(self, b)
+
+    def __contains__(self, res):
+        return self.bins.get(res) is not None
+
+    def get(self, res, default=None):
+        b = self.bins.get(res)
+        return default if b is None else JobCounts(self, b)
+
+    def __iter__(self):
+        return iter(self.bins.values)
+
+    def __len__(self):
+        return len(self.bins)
+
+
+class JobCounts(Mapping):
+    """
+    Job counts for one resource bin, as a view of a `JobCountsTable`.
+
+    Maps site -> resource name -> status -> count, plus `'_sum'` for
+    the bin totals.  Statuses with no jobs are left out.
+
+    Args:
+        table (JobCountsTable): table to view (default: a new table)
+        b (int): bin id in the table (default: a new bin)
+    """
+    def __init__(self, table=None, b=None):
+        if table is None:
+            table = JobCountsTable()
+        if b is None:
+            b = table._bin(None)
+        self.table = table
+        self.bin = b
+
+    def __getitem__(self, site):
+        if site == '_sum':
+            return _SumView(self.table, self.bin)
+        return _SiteView(self.table, self.bin, site)
+
+    def _site_ids(self):
+        row_site = self.table.row_site
+        return dict.fromkeys(row_site[row] for row in self.table.bin_rows[self.bin])
+
+    def __iter__(self):
+        sites = self.table.sites.values
+        return (sites[i] for i in self._site_ids())
+
+    def __len__(self):
+        return len(self._site_ids())
+
+    def __contains__(self, site):
+        if site == '_sum':
+            return True
+        site_id = self.table.sites.get(site)
+        return site_id is not None and site_id in self._site_ids()
+
+    def to_dict(self):
+        """Get counts as plain nested dicts"""
+        ret = {}
+        table = self.table
+        for row in table.bin_rows[self.bin]:
+            site = table.sites.values[table.row_site[row]]
+            resource = table.resource_names.values[table.row_resource[row]]
+            counts = {status: col[row] for status, col in zip(table.statuses.values, table.counts) if col[row]}
+            ret.setdefault(site, {})[resource] = counts
+        ret['_sum'] = dict(self['_sum'])
+        return ret
+
+
+class _Counter(MutableMapping):
+    """Status -> count for a column position, reading 0 for missing statuses"""
+    @abc.abstractmethod
+    def _cols(self):
+        """Get the count columns"""
+
+    @abc.abstractmethod
+    def _col(self, status, create=False):
+        """Get the column of a status, or None if missing and not `create`"""
+
+    @abc.abstractmethod
+    def _pos(self, create=False):
+        """Get the position in the columns, or None if missing and not `create`"""
+
+    def __getitem__(self, status):
+        col = self._col(status)
+        pos = self._pos()
+        return 0 if col is None or pos is None else col[pos]
+
+    def __setitem__(self, status, value):
+        self._col(status, create=True)[self._pos(create=True)] = value
+
+    def __delitem__(self, status):
+        col = self._col(status)
+        pos = self._pos()
+        if col is not None and pos is not None:
+            col[pos] = 0
 
     def __iter__(self):
-        return iter(self.keys())
+        pos = self._pos()
+        if pos is None:
+            return iter(())
+        statuses = self.table.statuses.values
+        return (statuses[s] for s, col in enumerate(self._cols()) if col[pos])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class _SumView(_Counter):
+    def __init__(self, table, b):
+        self.table = table
+        self.bin = b
+
+    def _cols(self):
+        return self.table.sums
+
+    def _col(self, status, create=False):
+        if create:
+            return self.table.sums[self.table._status(status)]
+        s = self.table.statuses.get(status)
+        return None if s is None else self.table.sums[s]
+
+    def _pos(self, create=False):
+        return self.bin
+
+
+class _SiteView(Mapping):
+    def __init__(self, table, b, site):
+        self.table = table
+        self.bin = b
+        self.site = site
+
+    def __getitem__(self, resource):
+        return _RowView(self.table, self.bin, self.site, resource)
+
+    def _resource_ids(self):
+        site_id = self.table.sites.get(self.site)
+        table = self.table
+        return dict.fromkeys(table.row_resource[row] for row in table.bin_rows[self.bin]
+                             if table.row_site[row] == site_id)
+
+    def __iter__(self):
+        names = self.table.resource_names.values
+        return (names[i] for i in self._resource_ids())
+
+    def __contains__(self, resource):
+        resource_id = self.table.resource_names.get(resource)
+        return resource_id is not None and resource_id in self._resource_ids()
+
+    def __len__(self):
+        return len(self._resource_ids())
+
+
+class _RowView(_Counter):
+    def __init__(self, table, b, site, resource):
+        self.table = table
+        self.bin = b
+        self.site = site
+        self.resource = resource
 
-    def keys(self):
-        return (k for k in super().keys() if k != '_sum')
+    def _cols(self):
+        return self.table.counts
 
-    def values(self):
-        return (self[k] for k in super().keys() if k != '_sum')
+    def _col(self, status, create=False):
+        if create:
+            return self.table.counts[self.table._status(status)]
+        s = self.table.statuses.get(status)
+        return None if s is None else self.table.counts[s]
 
-    def __missing__(self, key):
-        v = defaultdict(partial(defaultdict, int))
-        self[key] = v
-        return v
+    def _pos(self, create=False):
+        if create:
+            return self.table._row(self.bin, self.site, self.resource)
+        return self.table._find_row(self.bin, self.site, self.resource)
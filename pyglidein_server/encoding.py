@@ -0,0 +1,136 @@
+"""
+Content negotiation for request and response bodies.
+
+JSON is always available.  msgpack and CBOR are available when the
+optional `msgpack` and `cbor2` packages are installed.
+"""
+
+import json
+
+from tornado.web import HTTPError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+from .util import Error
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+# alternate names clients use for the same formats
+ALIASES = {
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.msgpack': MSGPACK,
+}
+
+
+def media_types():
+    """Get the media types supported by the installed packages"""
+    ret = [JSON]
+    if msgpack:
+        ret.append(MSGPACK)
+    if cbor2:
+        ret.append(CBOR)
+    return ret
+
+
+def _media_type(header):
+    """Strip parameters from a media type and resolve aliases"""
+    media_type = header.split(';', 1)[0].strip().lower()
+    return ALIASES.get(media_type, media_type)
+
+
+def decode(body, content_type=None):
+    """
+    Decode a request body.
+
+    A missing or unrecognized content type is treated as JSON, for
+    older clients, such as curl sending form-encoded JSON.
+
+    Args:
+        body (bytes): request body
+        content_type (str): value of the Content-Type header
+
+    Returns:
+        decoded body
+
+    Raises:
+        HTTPError: 415 if the content type needs a package that is not installed
+        Error: if the body cannot be decoded
+    """
+    media_type = _media_type(content_type) if content_type else JSON
+    if media_type not in (MSGPACK, CBOR):
+        media_type = JSON
+    elif media_type not in media_types():
+        raise HTTPError(415, reason=f'Content-Type must be one of: {media_types()}')
+    try:
+        if media_type == MSGPACK:
+            return msgpack.unpackb(body, raw=False, strict_map_key=False)
+        elif media_type == CBOR:
+            return cbor2.loads(body)
+        return json.loads(body)
+    except Exception:
+        raise Error(f'invalid {media_type} body')
+
+
+def negotiate(accept=None):
+    """
+    Pick the response media type from an Accept header.
+
+    Falls back to JSON if nothing acceptable is supported.
+
+    Args:
+        accept (str): value of the Accept header
+
+    Returns:
+        str: media type
+    """
+    if not accept:
+        return JSON
+    supported = media_types()
+    best = JSON
+    best_q = 0.
+    for entry in accept.split(','):
+        parts = entry.split(';')
+        media_type = _media_type(parts[0])
+        q = 1.
+        for p in parts[1:]:
+            k, _, v = p.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.
+        if media_type in ('*/*', 'application/*'):
+            media_type = JSON
+        # ties go to the first listed type
+        if media_type in supported and q > best_q:
+            best = media_type
+            best_q = q
+    return best
+
+
+def encode(data, media_type):
+    """
+    Encode a response body.
+
+    Args:
+        data: data to encode
+        media_type (str): a media type from `media_types()`
+
+    Returns:
+        bytes: encoded body
+    """
+    if media_type == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    elif media_type == CBOR:
+        return cbor2.dumps(data)
+    return json.dumps(data).encode('utf-8')
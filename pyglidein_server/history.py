@@ -0,0 +1,191 @@
+from array import array
+import time
+
+from .util import Error
+
+
+class History:
+    """
+    Time series of job and glidein counts per resource bin.
+
+    Each resolution is a ring buffer of `size` intervals, so memory
+    is fixed no matter how long the server runs.  Every sample adds to
+    the current interval of each resolution, and queries return the
+    mean of the samples in each interval.
+
+    Series are kept for at most `max_bins` resource bins, plus the total
+    over all bins.  Counts for bins past the limit are only added to
+    the total.
+
+    Args:
+        resolutions (list): seconds per interval of each ring buffer
+        size (int): number of intervals in each ring buffer
+        max_bins (int): max number of resource bins to keep series for
+    """
+    METRICS = ('jobs_queued', 'jobs_processing', 'glideins_queued', 'glideins_processing')
+
+    def __init__(self, resolutions=(10, 60, 600), size=360, max_bins=200):
+        if not resolutions or size < 1:
+            raise Exception('need at least one resolution and interval')
+        self.resolutions = sorted(resolutions)
+        self.size = size
+        self.max_bins = max_bins
+        self.dropped = 0  # samples of bins past the limit
+
+        # series index for each bin, with the total at index 0
+        self.bins = {}
+        self.bin_resources = [None]
+
+        # per resolution: the interval in each slot, and per series the
+        # sums of each metric and the number of samples in each slot
+        self.intervals = {r: array('q', [-1]) * size for r in self.resolutions}
+        self.sums = {r: [self._new_sums()] for r in self.resolutions}
+        self.samples = {r: [self._new_samples()] for r in self.resolutions}
+
+    def _new_sums(self):
+        return array('d', [0.]) * (self.size * len(self.METRICS))
+
+    def _new_samples(self):
+        return array('i', [0]) * self.size
+
+    def _series(self, res):
+        """Get the series index of a bin, or None if past the limit"""
+        if res in self.bins:
+            return self.bins[res]
+        if len(self.bins) >= self.max_bins:
+            self.dropped += 1
+            return None
+        idx = len(self.bin_resources)
+        self.bins[res] = idx
+        self.bin_resources.append(res)
+        for r in self.resolutions:
+            self.sums[r].append(self._new_sums())
+            self.samples[r].append(self._new_samples())
+        return idx
+
+    def record(self, jobs, glideins, now=None):
+        """
+        Record a sample of the current job and glidein counts.
+
+        Bins with a series but no counts are recorded as zero.
+
+        Args:
+            jobs (Mapping): `Resources` to `JobCounts`, from the condor cache
+            glideins (dict): `Resources` to glidein totals, from the clients
+            now (float): sample time (default: time.time())
+        """
+        if now is None:
+            now = time.time()
+
+        values = [[0.] * len(self.METRICS) for _ in self.bin_resources]
+        for res in jobs:
+            counts = jobs[res]['_sum']
+            queued = counts['queued']
+            processing = counts['processing']
+            values[0][0] += queued
+            values[0][1] += processing
+            idx = self._series(res)
+            if idx is not None:
+                if idx == len(values):
+                    values.append([0.] * len(self.METRICS))
+                values[idx][0] += queued
+                values[idx][1] += processing
+        for res, totals in glideins.items():
+            queued = totals['num_queued']
+            processing = totals['num_processing']
+            values[0][2] += queued
+            values[0][3] += processing
+            idx = self._series(res)
+            if idx is not None:
+                if idx == len(values):
+                    values.append([0.] * len(self.METRICS))
+                values[idx][2] += queued
+                values[idx][3] += processing
+
+        num = len(self.METRICS)
+        for r in self.resolutions:
+            interval = int(now // r)
+            slot = interval % self.size
+            sums = self.sums[r]
+            samples = self.samples[r]
+            if self.intervals[r][slot] != interval:
+                # the slot held an older interval, so clear it
+                self.intervals[r][slot] = interval
+                for idx in range(len(sums)):
+                    samples[idx][slot] = 0
+                    for m in range(num):
+                        sums[idx][slot * num + m] = 0.
+            for idx, v in enumerate(values):
+                samples[idx][slot] += 1
+                for m in range(num):
+                    sums[idx][slot * num + m] += v[m]
+
+    def _series_json(self, r, idx, intervals):
+        """Get the mean of each metric per interval, or None without samples"""
+        num = len(self.METRICS)
+        sums = self.sums[r][idx]
+        samples = self.samples[r][idx]
+        ret = {m: [] for m in self.METRICS}
+        for interval in intervals:
+            slot = interval % self.size
+            n = samples[slot] if self.intervals[r][slot] == interval else 0
+            for m, name in enumerate(self.METRICS):
+                ret[name].append(sums[slot * num + m] / n if n else None)
+        return ret
+
+    def query(self, start=None, end=None, resolution=None, now=None):
+        """
+        Get the history of a time range.
+
+        Without a resolution, the finest one that covers the start is used.
+
+        Args:
+            start (float): start time (default: one hour ago)
+            end (float): end time (default: now)
+            resolution (int): seconds per interval, one of `resolutions`
+            now (float): current time (default: time.time())
+
+        Returns:
+            dict: interval start times, and metrics for the total and each bin
+        """
+        if now is None:
+            now = time.time()
+        if end is None:
+            end = now
+        if start is None:
+            start = end - 3600
+        if start > end:
+            raise Error('start must be before end')
+
+        if resolution is None:
+            for resolution in self.resolutions:
+                if now - start <= resolution * self.size:
+                    break
+        elif resolution not in self.resolutions:
+            raise Error(f'resolution must be one of: {self.resolutions}')
+
+        # only intervals still in the ring buffer
+        last = int(min(end, now) // resolution)
+        first = max(int(start // resolution), int(now // resolution) - self.size + 1)
+        intervals = range(first, last + 1)
+
+        bins = {}
+        for res, idx in self.bins.items():
+            series = self._series_json(resolution, idx, intervals)
+            if any(v is not None for v in series['jobs_queued']):
+                series['_resources'] = res.resources
+                bins[hash(res)] = series
+
+        return {
+            'resolution': resolution,
+            'times': [i * resolution for i in intervals],
+            'total': self._series_json(resolution, 0, intervals),
+            'bins': bins,
+        }
+
+    def get_stats(self):
+        """Get history statistics"""
+        return {
+            'bins': len(self.bins),
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,36 @@
+import asyncio
+
+
+class Notifier:
+    """
+    Wake up waiters when matching inputs change.
+
+    Register `notify` as a listener on `Clients` and `CondorCache`,
+    then long-poll requests can `wait` for the next change.
+    """
+    def __init__(self):
+        self.event = None
+
+    def notify(self, *args, **kwargs):
+        """Wake up all current waiters"""
+        if self.event:
+            self.event.set()
+            self.event = None
+
+    async def wait(self, timeout):
+        """
+        Wait for the next notification.
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            bool: True if notified, False on timeout
+        """
+        if not self.event:
+            self.event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
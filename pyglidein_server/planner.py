@@ -0,0 +1,134 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Planner:
+    """
+    Allocates glideins across all clients in one pass.
+
+    Clients are matched one after another against the same condor
+    snapshot, and the glideins allocated to earlier clients count as
+    queued glideins for later clients, so clients polling at the same
+    time do not each get the same demand.  The order rotates with each
+    plan, so no client is always last.
+
+    A new plan is made on the next read after a condor refresh, or
+    after `update_threshold` client updates.  Reading a client's share
+    hands it out, so it is only returned once per plan.
+
+    Only clients that read a share within `active_window` seconds are
+    planned, so sites that stopped polling do not hold on to demand.
+    Other clients are planned on top of the current plan when they
+    next read.
+
+    Args:
+        clients (Clients): clients
+        condor (CondorPools): condor cache
+        update_threshold (int): client updates before making a new plan
+        active_window (float): seconds since a client's last read to include it in plans
+    """
+    def __init__(self, clients, condor, update_threshold=100, active_window=300):
+        self.clients = clients
+        self.condor = condor
+        self.update_threshold = update_threshold
+        self.active_window = active_window
+        self.last_read = {}
+        self.allocations = {}
+        self.planned = {}
+        self.taken = set()  # clients that took their share of this plan
+        self.condor_jobs = None
+        self.dirty = True
+        self.updates = 0
+        self.plans = 0
+        self.duration = 0.
+
+    def condor_refreshed(self, *args):
+        """Listener for condor refreshes"""
+        self.dirty = True
+
+    def clients_updated(self, names):
+        """Listener for client updates"""
+        self.updates += len(names)
+        if self.updates >= self.update_threshold:
+            self.dirty = True
+
+    def _plan_client(self, name):
+        """Allocate glideins to a client, on top of the current plan"""
+        ret = self.clients._match(name, self.condor_jobs, planned=self.planned)
+        refs = self.clients.refs[name]
+        for ref in ret:
+            res = refs[ref]
+            self.planned[res] = self.planned.get(res, 0) + ret[ref]
+        self.allocations[name] = ret
+
+    def plan(self):
+        """Make a new plan for all clients"""
+        start = time.monotonic()
+        self.clients.expire()
+        self.dirty = False
+        self.updates = 0
+        self.allocations = {}
+        self.planned = {}
+        self.taken = set()
+        self.condor_jobs = self.condor.get_cached()
+
+        cutoff = time.monotonic() - self.active_window
+        self.last_read = {name: t for name, t in self.last_read.items()
+                          if t >= cutoff and name in self.clients.data}
+        names = sorted(self.last_read)
+        if names:
+            offset = self.plans % len(names)
+            names = names[offset:] + names[:offset]
+        for name in names:
+            self._plan_client(name)
+
+        self.plans += 1
+        self.duration = time.monotonic() - start
+        logger.debug(f'planned {len(names)} clients in {self.duration:.3f}s')
+
+    def take(self, name):
+        """
+        Hand out a client's share of the current plan.
+
+        Args:
+            name (str): name of client
+
+        Returns:
+            dict: name of queue and number of jobs to submit
+        """
+        self.last_read[name] = time.monotonic()
+        if self.dirty:
+            self.plan()
+        if name not in self.allocations:
+            self._plan_client(name)
+        self.clients._touch(name)
+        refs = self.clients.refs[name]
+        ret = {ref: n for ref, n in self.allocations[name].items() if ref in refs}
+        self.allocations[name] = {}
+        self.taken.add(name)
+        return ret
+
+    def restore(self, name, ret):
+        """
+        Give back a share that could not be delivered to the client.
+
+        A share taken from an older plan is dropped, since the new plan
+        already includes it.
+
+        Args:
+            name (str): name of client
+            ret (dict): the share returned by `take`
+        """
+        if name in self.taken:
+            self.taken.discard(name)
+            self.allocations[name] = ret
+
+    def get_stats(self):
+        """Get planner statistics"""
+        return {
+            'plans': self.plans,
+            'duration': self.duration,
+            'clients': len(self.allocations),
+        }
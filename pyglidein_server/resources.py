@@ -1,3 +1,4 @@
+from functools import lru_cache
 
 
 class Resources:
@@ -52,6 +53,27 @@ class Resources:
         }
         return cls(resources)
 
+    @classmethod
+    def from_condor_row(cls, cpu, gpu, memory, disk, time, singularity):
+        """
+        Like `from_condor`, but from raw classad values.
+
+        Job sizes repeat a lot, so the binned resources are cached and
+        shared between calls.
+
+        Args:
+            cpu: RequestCPUs
+            gpu: RequestGPUs
+            memory: RequestMemory (in MB)
+            disk: RequestDisk (in KB)
+            time: OriginalTime (in seconds)
+            singularity: SingularityImage
+
+        Returns:
+            Resources: binned resources
+        """
+        return _from_condor_row(cls, cpu, gpu, memory, disk, time, bool(singularity))
+
     @classmethod
     def round(cls, resources, tolerance=None):
         """
@@ -135,3 +157,15 @@ class Resources:
                 bin = Resources.RESOURCE_BINS[k]
                 ret *= (bin.index(res.resources[k])+1.)/(bin.index(self.resources[k])+1.)
         return ret
+
+
+@lru_cache(maxsize=65536)
+def _from_condor_row(cls, cpu, gpu, memory, disk, time, singularity):
+    return cls({
+        'cpu': cpu,
+        'gpu': gpu,
+        'memory': memory//1000 if memory is not None else None,
+        'disk': disk//1000000 if disk is not None else None,
+        'time': time/3600. if time is not None else None,
+        'singularity': singularity,
+    })
@@ -2,86 +2,409 @@
 Server for pyglidein
 """
 
-import json
+import atexit
 import logging
+import math
+import time
 
+from tornado.ioloop import PeriodicCallback
 from tornado.web import HTTPError
 from rest_tools.server import (RestServer, RestHandler, RestHandlerSetup,
                                from_environment, role_authorization)
 
 from . import __version__ as version
-from .condor import CondorCache
+from . import encoding
+from .admission import AdmissionControl
+from .audit import AuditLog
+from .auth import TokenCache
+from .condor import CondorPools
 from .clients import Clients
+from .history import History
+from .notify import Notifier
+from .planner import Planner
+from .trace import TraceRecorder
 
 
 logger = logging.getLogger('server')
 
 
 class BaseHandler(RestHandler):
-    def initialize(self, condor, clients, **kwargs):
+    # whether requests are subject to admission control
+    admission = True
+    # whether requests need the first condor snapshot
+    requires_condor = False
+    # seconds for clients to wait while the condor cache warms up
+    NOT_READY_RETRY_AFTER = 5
+
+    def initialize(self, condor, clients, notifier=None, long_poll_timeout=0, token_cache=None,
+                   admission_control=None, history=None, planner=None, recorder=None, **kwargs):
         super().initialize(**kwargs)
         self.condor = condor
         self.clients = clients
+        self.token_cache = token_cache
+        self.notifier = notifier
+        self.long_poll_timeout = long_poll_timeout
+        self.admission_control = admission_control
+        self.history = history
+        self.planner = planner
+        self.recorder = recorder
+        self.admission_client = None
+        self.admitted = False
+        self.connection_closed = False
+
+    def reject(self, retry_after, reason):
+        """
+        Finish the request with a retryable 503.
+
+        Args:
+            retry_after (int): seconds before the client should retry
+            reason (str): reason for the rejection
+        """
+        self.set_status(503, reason=reason)
+        self.set_header('Retry-After', str(retry_after))
+        self.finish({'code': 503, 'error': f'{reason}, retry later'})
+
+    def prepare(self):
+        super().prepare()
+        if self.requires_condor and not self.condor.ready:
+            self.reject(self.NOT_READY_RETRY_AFTER, 'Server starting up')
+            return
+        if not (self.admission and self.admission_control):
+            return
+
+        # authenticate early (using the token cache) to find the client and role
+        priority = False
+        if self.auth and 'Authorization' in self.request.headers and self.current_user:
+            self.admission_client = self.auth_data.get('sub', None)
+            priority = self.auth_data.get('role', None) == 'admin'
+        else:
+            self.admission_client = self.path_kwargs.get('client', None) or self.request.remote_ip
+
+        handler = type(self).__name__
+        retry = self.admission_control.admit(handler, self.admission_client, priority=priority)
+        if retry is not None:
+            self.reject(retry, 'Server overloaded')
+            return
+        self.admitted = True
+
+    def release_admission(self, duration=None):
+        """Release this request's admission slot, such as before a long wait"""
+        if self.admitted:
+            self.admitted = False
+            self.admission_control.release(type(self).__name__, self.admission_client, duration=duration)
+
+    def on_finish(self):
+        self.release_admission(duration=self.request.request_time())
+        super().on_finish()
+
+    def get_current_user(self):
+        """Get the current user, skipping verification of recently seen tokens"""
+        if not self.token_cache:
+            return super().get_current_user()
+        try:
+            token_type, token = self.request.headers['Authorization'].split(' ', 1)
+            if token_type.lower() != 'bearer':
+                raise Exception('bad header type')
+            data = self.token_cache.get(token)
+            if data is None:
+                data = self.auth.validate(token)
+                self.token_cache.put(token, data)
+            self.auth_data = data
+            self.auth_key = token
+            return data['sub']
+        except Exception as e:
+            logger.debug(f'failed auth: {e!r}')
+        return None
+
+    def on_connection_close(self):
+        self.connection_closed = True
+        super().on_connection_close()
+
+    def get_body(self):
+        """Decode the request body based on the Content-Type header"""
+        if not self.request.body:
+            return None
+        return encoding.decode(self.request.body, self.request.headers.get('Content-Type', None))
+
+    def write_data(self, data):
+        """Write a response body based on the Accept header"""
+        self.add_header('Vary', 'Accept')
+        media_type = encoding.negotiate(self.request.headers.get('Accept', None))
+        if media_type == encoding.JSON:
+            self.write(data)
+        else:
+            self.set_header('Content-Type', media_type)
+            self.write(encoding.encode(data, media_type))
+
+    def check_client_access(self, client):
+        """
+        Check that the current token may act on a client.
+
+        Admins may act on any client, clients only on themselves,
+        and gateways on the clients listed in their token.
+        """
+        role = self.auth_data.get('role', None)
+        if role == 'client' and client != self.auth_data.get('sub', None):
+            raise HTTPError(403, reason='Cannot update a different client than your own')
+        if role == 'gateway' and client not in self.auth_data.get('clients', []):
+            raise HTTPError(403, reason=f'Gateway cannot update client {client}')
+
+    def match(self, client):
+        """
+        Get the glideins a client should submit.
+
+        Reads the client's share of the plan, if there is a planner,
+        or else matches the client directly.
+
+        Returns:
+            dict: name of queue and number of jobs to submit
+        """
+        if self.planner:
+            return self.planner.take(client)
+        return self.clients.match(client, self.condor)
+
+    def unmatch(self, client, ret):
+        """Give back a match result that was not delivered to the client"""
+        if self.planner and ret:
+            self.planner.restore(client, ret)
+
+    def pool_for(self, client, queues):
+        """Pick the condor pool for the glideins a client should submit"""
+        resources = [res for res, queue in self.clients.get(client).items() if queue['ref'] in queues]
+        return self.condor.pool_for(resources)
 
 
 class StatusHandler(BaseHandler):
+    admission = False
+
     async def get(self):
-        self.write({
+        self.write_data({
             'condor': self.condor.get_json(),
             'clients': self.clients.get_json(),
+            'stats': {
+                'clients': self.clients.get_stats(),
+                'condor': self.condor.get_stats(),
+                'auth': self.token_cache.get_stats() if self.token_cache else {},
+                'admission': self.admission_control.get_stats() if self.admission_control else {},
+                'history': self.history.get_stats() if self.history else {},
+                'planner': self.planner.get_stats() if self.planner else {},
+                'trace': self.recorder.get_stats() if self.recorder else {},
+            },
         })
 
 
+class HealthHandler(BaseHandler):
+    admission = False
+
+    async def get(self):
+        self.write_data({'status': 'ok'})
+
+
+class ReadyHandler(BaseHandler):
+    admission = False
+
+    async def get(self):
+        if not self.condor.ready:
+            self.set_status(503)
+        self.write_data({'ready': self.condor.ready})
+
+
+class APIHistory(BaseHandler):
+    async def get(self):
+        args = {}
+        for name, convert in (('start', float), ('end', float), ('resolution', int)):
+            value = self.get_query_argument(name, None)
+            if value is not None:
+                try:
+                    args[name] = convert(value)
+                except ValueError:
+                    args[name] = math.nan
+                if not math.isfinite(args[name]):
+                    raise HTTPError(400, reason=f'"{name}" must be a number')
+        if not self.history:
+            raise HTTPError(404, reason='History is disabled')
+        self.write_data(self.history.query(**args))
+
+
 class APITokens(BaseHandler):
     @role_authorization(roles=['admin'])
     async def post(self):
-        data = json.loads(self.request.body)
+        data = self.get_body()
         if (not data) or 'client' not in data:
             raise HTTPError(400, reason='Missing "client" in body')
 
-        token = self.auth.create_token(data['client'], type='client',
-                                       payload={'role': 'client'})
-        self.write({'client': data['client'], 'token': token})
+        if 'clients' in data:
+            if not isinstance(data['clients'], list):
+                raise HTTPError(400, reason='"clients" must be a list')
+            token = self.auth.create_token(data['client'], type='client',
+                                           payload={'role': 'gateway', 'clients': data['clients']})
+            self.write({'client': data['client'], 'clients': data['clients'], 'token': token})
+        else:
+            token = self.auth.create_token(data['client'], type='client',
+                                           payload={'role': 'client'})
+            self.write({'client': data['client'], 'token': token})
+
+
+class APITokenCache(BaseHandler):
+    @role_authorization(roles=['admin'])
+    async def delete(self):
+        """Flush the verified token cache"""
+        if self.token_cache:
+            self.token_cache.flush()
+        self.write({})
 
 
 class APIClient(BaseHandler):
-    @role_authorization(roles=['admin', 'client'])
+    @role_authorization(roles=['admin', 'client', 'gateway'])
     async def put(self, client):
-        if self.auth_data.get('role', None) == 'client' and client != self.auth_data.get('sub', None):
-            raise HTTPError(403, reason='Cannot update a different client than your own')
+        self.check_client_access(client)
 
-        if self.request.body:
-            data = json.loads(self.request.body)
-            self.clients.update(client, data)
-        else:
-            self.clients.update(client, {})
+        data = self.get_body()
+        self.clients.update(client, data if data is not None else {})
 
-        self.write({})
+        self.write_data({})
+
+    @role_authorization(roles=['admin', 'client', 'gateway'])
+    async def patch(self, client):
+        self.check_client_access(client)
+
+        data = self.get_body()
+        if data is None:
+            raise HTTPError(400, reason='Need to provide client queue changes')
+        self.clients.patch(client, data)
+
+        self.write_data({})
 
 
 class APIClientQueue(BaseHandler):
-    @role_authorization(roles=['admin', 'client'])
+    requires_condor = True
+
+    @role_authorization(roles=['admin', 'client', 'gateway'])
     async def post(self, client):
-        if self.auth_data.get('role', None) == 'client' and client != self.auth_data.get('sub', None):
-            raise HTTPError(403, reason='Cannot update a different client than your own')
+        self.check_client_access(client)
 
-        if self.request.body:
-            status = json.loads(self.request.body)
-            self.clients.update(client, status)
+        status = self.get_body()
+        if status is not None:
+            if self.get_query_argument('partial', 'false').lower() in ('true', '1'):
+                self.clients.patch(client, status)
+            else:
+                self.clients.update(client, status)
 
         try:
             self.clients.get(client)
         except KeyError:
             raise HTTPError(400, reason='Need to provide client queue status')
 
-        ret = self.clients.match(client, self.condor)
+        await self.condor.refresh(background=True)
+        ret = self.match(client)
         if not ret:
-            self.write({})
+            ret = await self.long_poll(client)
+        if self.connection_closed:
+            self.unmatch(client, ret)
+            return
+
+        resp = {}
+        if ret:
+            try:
+                pool = self.pool_for(client, ret)
+                resp = {
+                    'queues': ret,
+                    'pool': pool,
+                }
+                # skip fetching a token the client already has
+                if pool not in self.get_query_argument('have_token', '').split(','):
+                    resp['token'] = self.condor.get_startd_token(pool)
+            except Exception:
+                self.unmatch(client, ret)
+                raise
+        if self.recorder:
+            self.recorder.record_match(client, ret)
+        self.write_data(resp)
+
+    async def long_poll(self, client):
+        """
+        Wait for the match result of a client to have something to submit.
+
+        Enabled with the `wait` query argument (in seconds), up to the
+        server's long poll timeout.  Wakes up on client updates and condor
+        cache refreshes, and at least every condor cache timeout so the
+        cache gets refreshed.
+
+        Returns:
+            dict: name of queue and number of jobs to submit
+        """
+        try:
+            wait = float(self.get_query_argument('wait', '0'))
+        except ValueError:
+            wait = -1
+        if not math.isfinite(wait) or wait < 0:
+            raise HTTPError(400, reason='"wait" must be a number of seconds')
+        wait = min(wait, self.long_poll_timeout)
+        if wait <= 0 or not self.notifier:
+            return {}
+
+        # waiting is cheap, so do not hold an admission slot for it
+        self.release_admission()
+
+        deadline = time.monotonic() + wait
+        ret = {}
+        while not ret and not self.connection_closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await self.notifier.wait(min(remaining, self.condor.cache_timeout))
+            await self.condor.refresh(background=True)
+            ret = self.match(client)
+        return ret
+
+
+class APIClientsQueue(BaseHandler):
+    requires_condor = True
+
+    @role_authorization(roles=['admin', 'client', 'gateway'])
+    async def post(self):
+        """
+        Update and match many clients in one request.
+
+        Body is a dict of client name to queue status.  A `null` status
+        matches the client with its last known queue status.
+        """
+        data = self.get_body()
+        if not data or not isinstance(data, dict):
+            raise HTTPError(400, reason='Need to provide client queue statuses')
+        for client in data:
+            self.check_client_access(client)
+            if data[client] is None:
+                try:
+                    self.clients.get(client)
+                except KeyError:
+                    raise HTTPError(400, reason=f'Need to provide client queue status for {client}')
+
+        self.clients.update_many({c: data[c] for c in data if data[c] is not None})
+
+        await self.condor.refresh(background=True)
+        if self.planner:
+            ret = {client: self.planner.take(client) for client in data}
         else:
-            self.write({
-                'queues': ret,
-                'token': self.condor.get_startd_token()
-            })
+            ret = self.clients.match_many(data, self.condor)
+
+        resp = {'clients': ret}
+        if any(ret.values()):
+            try:
+                pools = {client: self.pool_for(client, ret[client]) for client in ret if ret[client]}
+                tokens = {pool: self.condor.get_startd_token(pool) for pool in set(pools.values())}
+            except Exception:
+                for client in ret:
+                    self.unmatch(client, ret[client])
+                raise
+            resp['pools'] = pools
+            resp['tokens'] = tokens
+            if len(tokens) == 1:
+                resp['token'] = list(tokens.values())[0]
+        if self.recorder:
+            for client in ret:
+                self.recorder.record_match(client, ret[client])
+        self.write_data(resp)
 
 
 def create_server():
@@ -95,8 +418,32 @@ def create_server():
         # 'COOKIE_SECRET': binascii.hexlify(b'secret').decode('utf-8'),
         'AUTH_SECRET': '',
         'AUTH_EXPIRATION': -1,  # seconds for token lifetime
-        'CONDOR_COLLECTOR': 'localhost',
+        'AUTH_CACHE_SIZE': 10000,  # verified tokens to cache, 0 to disable
+        'AUTH_CACHE_MAX_AGE': 300,  # max seconds to trust a cached verification
+        'CONDOR_COLLECTOR': 'localhost',  # comma-separated for multiple pools
+        'CONDOR_POOL_TIMEOUT': 300,  # max seconds for one pool refresh
         'CONDOR_CACHE_TIMEOUT': 60,
+        'CONDOR_CACHE_TIMEOUT_MIN': 10,
+        'CONDOR_CACHE_TIMEOUT_MAX': 300,
+        'CONDOR_REFRESH_MAX_SHARE': 0.25,  # max fraction of time spent refreshing
+        'CONDOR_SCHEDD_TIMEOUT': 600,  # seconds between locating schedds
+        'CONDOR_WARM_UP': True,  # load the first snapshot after startup, instead of before
+        'LONG_POLL_TIMEOUT': 300,  # max seconds to hold a queue request open
+        'CLIENT_TTL': 3600,  # seconds before an idle client is evicted, 0 to disable
+        'AUDIT_LOG_FILE': '',  # file for match decision records, empty to disable
+        'AUDIT_SAMPLE_RATE': 0.01,  # fraction of matches to record
+        'AUDIT_LOG_MAX_BYTES': 10000000,  # max size of the audit log before rotating
+        'AUDIT_LOG_BACKUPS': 5,  # rotated audit logs to keep
+        'HISTORY_RESOLUTIONS': '10,60,600',  # comma-separated seconds per interval, empty to disable
+        'HISTORY_SIZE': 360,  # intervals kept at each resolution
+        'HISTORY_MAX_BINS': 200,  # max resource bins to keep history for
+        'PLANNER_UPDATES': 100,  # client updates before a new allocation plan, 0 to match per request
+        'PLANNER_ACTIVE_WINDOW': 300,  # seconds since a client last polled to include it in plans
+        'TRACE_FILE': '',  # file to record a trace of server traffic to, empty to disable
+        'TRACE_FLUSH_INTERVAL': 10,  # max seconds to buffer trace events for a gzip trace
+        'ADMISSION_HANDLER_LIMIT': 100,  # max in-flight requests per handler, 0 to disable
+        'ADMISSION_CLIENT_LIMIT': 4,  # max in-flight requests per client, 0 to disable
+        'ADMISSION_PRIORITY_RESERVE': 10,  # extra in-flight requests per handler for admins
     }
     config = from_environment(default_config)
 
@@ -114,11 +461,57 @@ def create_server():
     args = RestHandlerSetup(rest_cfg)
 
     condor_args = {
-        'collector_address': config['CONDOR_COLLECTOR'],
+        'collector_addresses': [c.strip() for c in config['CONDOR_COLLECTOR'].split(',') if c.strip()],
+        'pool_timeout': config['CONDOR_POOL_TIMEOUT'],
         'cache_timeout': config['CONDOR_CACHE_TIMEOUT'],
+        'min_cache_timeout': config['CONDOR_CACHE_TIMEOUT_MIN'],
+        'max_cache_timeout': config['CONDOR_CACHE_TIMEOUT_MAX'],
+        'max_refresh_share': config['CONDOR_REFRESH_MAX_SHARE'],
+        'schedd_timeout': config['CONDOR_SCHEDD_TIMEOUT'],
+        'lazy': config['CONDOR_WARM_UP'],
     }
-    args['condor'] = CondorCache(**condor_args)
-    args['clients'] = Clients()
+    args['condor'] = CondorPools(**condor_args)
+    audit = None
+    if config['AUDIT_LOG_FILE']:
+        audit = AuditLog(config['AUDIT_LOG_FILE'], sample_rate=config['AUDIT_SAMPLE_RATE'],
+                         max_bytes=config['AUDIT_LOG_MAX_BYTES'],
+                         backup_count=config['AUDIT_LOG_BACKUPS'])
+    args['clients'] = Clients(ttl=config['CLIENT_TTL'], audit=audit)
+    args['notifier'] = Notifier()
+    args['condor'].add_listener(args['notifier'].notify)
+    args['clients'].add_listener(args['notifier'].notify)
+    args['long_poll_timeout'] = config['LONG_POLL_TIMEOUT']
+    if config['TRACE_FILE']:
+        recorder = TraceRecorder(config['TRACE_FILE'], flush_interval=config['TRACE_FLUSH_INTERVAL'])
+        PeriodicCallback(recorder.flush, config['TRACE_FLUSH_INTERVAL'] * 1000).start()
+        atexit.register(recorder.close)
+        args['condor'].add_listener(lambda condor: recorder.record_condor(condor.get_cached()))
+        args['clients'].add_listener(lambda names: recorder.record_clients(args['clients'], names))
+        args['recorder'] = recorder
+    if config['PLANNER_UPDATES'] > 0:
+        planner = Planner(args['clients'], args['condor'], update_threshold=config['PLANNER_UPDATES'],
+                          active_window=config['PLANNER_ACTIVE_WINDOW'])
+        args['condor'].add_listener(planner.condor_refreshed)
+        args['clients'].add_listener(planner.clients_updated)
+        args['planner'] = planner
+    resolutions = [int(r) for r in config['HISTORY_RESOLUTIONS'].split(',') if r.strip()]
+    if resolutions:
+        history = History(resolutions, size=config['HISTORY_SIZE'], max_bins=config['HISTORY_MAX_BINS'])
+
+        def record_history(*_):
+            history.record(args['condor'].get_cached(), args['clients'].totals)
+        args['condor'].add_listener(record_history)
+        args['clients'].add_listener(record_history)
+        args['history'] = history
+    if config['AUTH_CACHE_SIZE'] > 0:
+        args['token_cache'] = TokenCache(size=config['AUTH_CACHE_SIZE'],
+                                         max_age=config['AUTH_CACHE_MAX_AGE'])
+
+    args['admission_control'] = AdmissionControl(
+        handler_limit=config['ADMISSION_HANDLER_LIMIT'],
+        client_limit=config['ADMISSION_CLIENT_LIMIT'],
+        priority_reserve=config['ADMISSION_PRIORITY_RESERVE'],
+    )
 
     server = RestServer(debug=config['DEBUG'],
                         # static_path=static_path, template_path=template_path,
@@ -126,10 +519,18 @@ def create_server():
                         )
 
     server.add_route(r'/status', StatusHandler, args)
+    server.add_route(r'/healthz', HealthHandler, args)
+    server.add_route(r'/readyz', ReadyHandler, args)
+    server.add_route(r'/api/history', APIHistory, args)
     server.add_route(r'/api/tokens', APITokens, args)
+    server.add_route(r'/api/tokens/cache', APITokenCache, args)
+    server.add_route(r'/api/actions/queue', APIClientsQueue, args)
     server.add_route(r'/api/clients/(?P<client>\w+)', APIClient, args)
     server.add_route(r'/api/clients/(?P<client>\w+)/actions/queue', APIClientQueue, args)
 
     server.startup(address=config['HOST'], port=config['PORT'])
 
+    if config['CONDOR_WARM_UP']:
+        args['condor'].warm_up()
+
     return server
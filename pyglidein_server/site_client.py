@@ -0,0 +1,247 @@
+"""
+Client library for pyglidein sites.
+
+Example::
+
+    async with SiteClient('https://glidein.example.com', token, 'mysite') as client:
+        ret = await client.queue(queues, wait=60)
+        for ref, num in ret.get('queues', {}).items():
+            submit(ref, num, pool=ret['pool'], token=ret['token'])
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import partial
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class SiteClient:
+    """
+    Async client for a site to report queue status and get glideins to submit.
+
+    Requests run in a dedicated pool of `pool_size` threads, each with
+    its own keep-alive session, since sessions are not thread-safe.
+    Connection errors and retryable responses are retried with jittered
+    exponential backoff, honoring `Retry-After`.
+
+    After the first report, only queues that changed are sent.  Startd
+    tokens are cached per pool, so the server can skip fetching them.
+    A cached token is only offered if it outlives the request.
+
+    Args:
+        address (str): server address
+        token (str): client auth token
+        client (str): name of client
+        timeout (float): seconds per request attempt
+        retries (int): max retries per request
+        backoff (float): seconds of the first retry backoff
+        max_backoff (float): max seconds of a retry backoff
+        pool_size (int): max concurrent requests
+        token_ttl (float): seconds to reuse a startd token
+    """
+    RETRY_STATUS = {429, 502, 503, 504}
+
+    def __init__(self, address, token, client, timeout=60, retries=5, backoff=0.5, max_backoff=60,
+                 pool_size=4, token_ttl=3600):
+        self.address = address.rstrip('/')
+        self.token = token
+        self.client = client
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.token_ttl = token_ttl
+        self.last_sent = None
+        self.startd_tokens = {}  # pool to (token, expiration)
+
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.local = threading.local()
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.sessions_lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+
+    def _session(self):
+        """Get the session of the current executor thread"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Authorization'] = f'Bearer {self.token}'
+            self.local.session = session
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    def _send(self, method, url, **kwargs):
+        return self._session().request(method, url, **kwargs)
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Get the seconds to wait before a retry.
+
+        Args:
+            attempt (int): number of attempts so far
+            response (requests.Response): the failed response, if any
+
+        Returns:
+            float: seconds
+        """
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def request(self, method, path, body=None, params=None, timeout=None):
+        """
+        Make a request, retrying on connection errors and retryable statuses.
+
+        Args:
+            method (str): http method
+            path (str): url path
+            body: json body (default: none)
+            params (dict): query arguments
+            timeout (float): seconds per attempt (default: the client timeout)
+
+        Returns:
+            decoded json response
+        """
+        url = self.address + path
+        if params:
+            url += '?' + urlencode(params)
+        kwargs = {'timeout': self.timeout if timeout is None else timeout}
+        if body is not None:
+            kwargs['json'] = body
+
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            try:
+                response = await loop.run_in_executor(self.executor, partial(self._send, method, url, **kwargs))
+                if response.status_code not in self.RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json() if response.content else None
+                if attempt > self.retries:
+                    response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt > self.retries:
+                    raise
+            delay = self.retry_delay(attempt, response)
+            logger.info(f'retrying {method} {path} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    def _changes(self, queues):
+        """Get the queues that changed since the last report, or None for no change"""
+        changes = {}
+        for ref, queue in queues.items():
+            old = self.last_sent.get(ref, None)
+            if old is None:
+                changes[ref] = queue
+            else:
+                diff = {k: v for k, v in queue.items() if old.get(k, None) != v}
+                if diff:
+                    changes[ref] = diff
+        for ref in self.last_sent:
+            if ref not in queues:
+                changes[ref] = None
+        return changes or None
+
+    def _have_tokens(self, timeout):
+        """
+        Get the cached startd tokens still valid after a request.
+
+        Expired tokens are dropped.
+
+        Args:
+            timeout (float): max seconds the request may take
+
+        Returns:
+            dict: pool to token
+        """
+        now = time.time()
+        for pool in [p for p, (_, expiration) in self.startd_tokens.items() if expiration <= now]:
+            del self.startd_tokens[pool]
+        return {pool: token for pool, (token, expiration) in self.startd_tokens.items()
+                if expiration > now + timeout}
+
+    async def update(self, queues):
+        """
+        Report the full queue status of the site.
+
+        Args:
+            queues (dict): queue information, keyed by queue name
+        """
+        await self.request('PUT', f'/api/clients/{self.client}', queues)
+        self.last_sent = deepcopy(queues)
+
+    async def queue(self, queues, wait=None):
+        """
+        Report queue status, and get the glideins to submit.
+
+        Args:
+            queues (dict): queue information, keyed by queue name
+            wait (float): seconds to wait for something to submit (default: no wait)
+
+        Returns:
+            dict: `queues` with the number to submit per queue, and the `pool` and `token` to use
+        """
+        # the server holds a long poll open for up to `wait` seconds
+        timeout = self.timeout + (wait or 0)
+        params = {}
+        if wait:
+            params['wait'] = wait
+        have_tokens = self._have_tokens(timeout * (self.retries + 1))
+        if have_tokens:
+            params['have_token'] = ','.join(have_tokens)
+
+        path = f'/api/clients/{self.client}/actions/queue'
+        body = queues
+        if self.last_sent is not None:
+            body = self._changes(queues)
+            params['partial'] = 'true'
+        try:
+            ret = await self.request('POST', path, body, params=params, timeout=timeout)
+        except requests.HTTPError as e:
+            if self.last_sent is None or e.response.status_code != 400:
+                raise
+            # the server may have evicted this client, so send everything
+            logger.info('partial update failed, sending full queue status')
+            del params['partial']
+            ret = await self.request('POST', path, queues, params=params, timeout=timeout)
+        self.last_sent = deepcopy(queues)
+
+        if ret and 'pool' in ret:
+            pool = ret['pool']
+            if 'token' in ret:
+                self.startd_tokens[pool] = (ret['token'], time.time() + self.token_ttl)
+            else:
+                ret['token'] = have_tokens[pool]
+        return ret or {}
@@ -0,0 +1,309 @@
+"""
+Record and replay traces of server traffic.
+
+A trace is a JSON lines file, with one event per line.  If the name
+ends in `.gz`, events are buffered and written as a series of complete
+gzip members, so a crash only loses the unwritten buffer.  Event types:
+
+* `condor`: the job counts of each resource bin after a refresh
+* `update`: the queues of a client after an update
+* `match`: the glideins a client was told to submit
+
+Replaying a trace feeds the events through `Clients` and a condor
+stand-in, to benchmark matching against real traffic shapes::
+
+    python -m pyglidein_server.trace trace.jsonl.gz --speed 10
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import time
+import zlib
+
+from .clients import Clients
+from .condor import JobCountsTable
+from .planner import Planner
+from .resources import Resources
+
+logger = logging.getLogger(__name__)
+
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+class TraceRecorder:
+    """
+    Append server events to a trace file.
+
+    Plain traces are flushed after every event.  Gzip traces are
+    flushed every `flush_events` events or `flush_interval` seconds,
+    whichever comes first, and on `flush` or `close`.
+
+    Args:
+        filename (str): path of the trace file
+        flush_events (int): max events buffered for a gzip trace
+        flush_interval (float): max seconds to buffer events for a gzip trace
+    """
+    def __init__(self, filename, flush_events=100, flush_interval=10):
+        self.filename = filename
+        self.gzip = filename.endswith('.gz')
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self.file = open(filename, 'ab')
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.events = 0
+
+    def _write(self, event, **fields):
+        fields['t'] = time.time()
+        fields['event'] = event
+        line = json.dumps(fields, separators=(',', ':')) + '\n'
+        self.events += 1
+        if not self.gzip:
+            self.file.write(line.encode('utf-8'))
+            self.file.flush()
+            return
+        self.buffer.append(line)
+        if len(self.buffer) >= self.flush_events or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write buffered events as one complete gzip member"""
+        self.last_flush = time.monotonic()
+        if self.buffer:
+            self.file.write(gzip.compress(''.join(self.buffer).encode('utf-8')))
+            self.file.flush()
+            self.buffer = []
+
+    def record_condor(self, jobs):
+        """
+        Record a condor snapshot.
+
+        Args:
+            jobs (Mapping): `Resources` to `JobCounts`
+        """
+        bins = []
+        for res in jobs:
+            counts = jobs[res]['_sum']
+            bins.append([res.resources, counts['queued'], counts['processing']])
+        self._write('condor', bins=bins)
+
+    def record_clients(self, clients, names):
+        """
+        Record the current queues of updated clients.
+
+        Evicted clients are recorded with no queues.
+
+        Args:
+            clients (Clients): clients
+            names (list): names of updated clients
+        """
+        for name in names:
+            queues = {}
+            for res, queue in clients.data.get(name, {}).items():
+                queues[queue['ref']] = {
+                    'resources': res.resources,
+                    'num_queued': queue['num_queued'],
+                    'num_processing': queue['num_processing'],
+                }
+            self._write('update', client=name, queues=queues)
+
+    def record_match(self, client, result):
+        """
+        Record a match result.
+
+        Args:
+            client (str): name of client
+            result (dict): name of queue and number of jobs to submit
+        """
+        self._write('match', client=client, result=result)
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def get_stats(self):
+        """Get recording statistics"""
+        return {
+            'filename': self.filename,
+            'events': self.events,
+        }
+
+
+class ReplayCondor:
+    """Condor stand-in that serves the last replayed snapshot"""
+    def __init__(self):
+        self.cache = JobCountsTable()
+
+    def set(self, bins):
+        cache = JobCountsTable()
+        for resources, queued, processing in bins:
+            res = Resources(resources, tolerance=1)
+            if queued:
+                cache.add(res, None, None, 'queued', queued)
+            if processing:
+                cache.add(res, None, None, 'processing', processing)
+        cache.freeze()
+        self.cache = cache
+
+    def get(self):
+        return self.cache
+
+    def get_cached(self):
+        return self.cache
+
+
+def _read_gzip_lines(f, chunk_size=1 << 20):
+    """
+    Read lines from concatenated gzip members.
+
+    Each member holds whole lines, which are only returned once the
+    member is complete and its checksum matches.  A truncated or
+    damaged member is skipped.
+    """
+    d = None
+    pending = b''
+    start = None  # offset of the current member in `pending`, if it started there
+    buf = b''  # decompressed data of the current member
+    while True:
+        if not pending:
+            pending = f.read(chunk_size)
+            if not pending:
+                break
+            start = 0 if d is None else None
+        if d is None:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            out = d.decompress(pending)
+        except zlib.error:
+            logger.warning('skipping damaged trace data')
+            d = None
+            buf = b''
+            idx = pending.find(GZIP_MAGIC, 0 if start is None else start + 1)
+            pending = pending[idx:] if idx >= 0 else b''
+            start = 0
+            continue
+        buf += out
+        if d.eof:
+            yield from buf.split(b'\n')
+            pending = d.unused_data
+            d = None
+            buf = b''
+            start = 0
+        else:
+            pending = b''
+    if d is not None:
+        logger.warning('trace ends with a truncated gzip member')
+
+
+def read_trace(filename):
+    """
+    Iterate over the events of a trace file.
+
+    Stops cleanly at a partially written end, and skips damaged data
+    in the middle of gzip traces.
+    """
+    with open(filename, 'rb') as f:
+        lines = _read_gzip_lines(f) if filename.endswith('.gz') else f
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning('skipping partial trace event')
+
+
+def replay(events, speed=0, planner_updates=0):
+    """
+    Replay trace events.
+
+    Args:
+        events (iterable): trace events
+        speed (float): speedup over the original timing (default: as fast as possible)
+        planner_updates (int): use a `Planner` with this update threshold (default: match per request)
+
+    Returns:
+        dict: throughput, match latency, and glideins per site
+    """
+    clients = Clients()
+    condor = ReplayCondor()
+    planner = None
+    if planner_updates > 0:
+        planner = Planner(clients, condor, update_threshold=planner_updates)
+        clients.add_listener(planner.clients_updated)
+
+    latencies = []
+    glideins = {}
+    recorded = {}
+    num = 0
+    trace_start = None
+    start = time.perf_counter()
+    for event in events:
+        if speed > 0:
+            if trace_start is None:
+                trace_start = event['t']
+            delay = (event['t'] - trace_start) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        num += 1
+        kind = event['event']
+        if kind == 'condor':
+            condor.set(event['bins'])
+            if planner:
+                planner.condor_refreshed()
+        elif kind == 'update':
+            clients.update(event['client'], event['queues'])
+        elif kind == 'match':
+            name = event['client']
+            if name not in clients.data:
+                logger.info(f'match for unknown client {name}')
+                continue
+            t = time.perf_counter()
+            ret = planner.take(name) if planner else clients.match(name, condor)
+            latencies.append(time.perf_counter() - t)
+            glideins[name] = glideins.get(name, 0) + sum(ret.values())
+            recorded[name] = recorded.get(name, 0) + sum(event['result'].values())
+        else:
+            logger.warning(f'unknown trace event {kind}')
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+    return {
+        'events': num,
+        'duration': duration,
+        'events_per_second': num / duration if duration > 0 else None,
+        'matches': len(latencies),
+        'match_latency': {
+            'p50': percentile(.5),
+            'p99': percentile(.99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'glideins': glideins,
+        'recorded_glideins': recorded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a pyglidein server trace')
+    parser.add_argument('trace', help='trace file')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='speedup over the original timing, 0 for as fast as possible')
+    parser.add_argument('--planner', type=int, default=0, metavar='UPDATES',
+                        help='use the planner, with this many client updates per plan')
+    args = parser.parse_args()
+
+    ret = replay(read_trace(args.trace), speed=args.speed, planner_updates=args.planner)
+    print(json.dumps(ret, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import itertools
+import random
+import time
+
+import classad
+import htcondor
+
+from pyglidein_server.condor import CondorCache
+from pyglidein_server.resources import Resources
+
+
+def make_ads(num, seed=0):
+    """Make a pool of synthetic job ads, like a schedd query would return"""
+    rand = random.Random(seed)
+    ads = []
+    for _ in range(num):
+        ad = classad.ClassAd({
+            'JobStatus': rand.choice([1, 1, 1, 2, 2, 5]),
+            'RequestCPUs': rand.choice([1, 1, 2, 4, 8]),
+            'RequestGPUs': rand.choice([0, 0, 0, 1]),
+            'RequestMemory': classad.ExprTree(f'ifThenElse(MemoryUsage isnt undefined, MemoryUsage, {rand.randint(500, 16000)})'),
+            'RequestDisk': rand.randint(1000000, 50000000),
+            'OriginalTime': rand.choice([3600, 7200, 43200]),
+        })
+        if rand.random() < .5:
+            ad['SingularityImage'] = '/cvmfs/singularity.opensciencegrid.org/foo:latest'
+        if ad['JobStatus'] == 2:
+            ad['MachineAttrGLIDEIN_Site0'] = rand.choice(['site1', 'site2', 'site3'])
+            ad['MachineAttrGLIDEIN_ResourceName0'] = rand.choice(['res1', 'res2'])
+        ads.append(ad)
+    return ads
+
+
+def convert_classads_path(ads):
+    """The previous extraction path: evaluate every key, then bin"""
+    counts = {}
+    for job in ads:
+        ad = CondorCache.convert_classads(job)
+        status = htcondor.JobStatus(ad.get('JobStatus', 1))
+        if status == htcondor.JobStatus.IDLE:
+            status = 'queued'
+        elif status == htcondor.JobStatus.RUNNING:
+            status = 'processing'
+        else:
+            status = 'unknown'
+        key = (Resources.from_condor(ad), ad.get('MachineAttrGLIDEIN_Site0', None),
+               ad.get('MachineAttrGLIDEIN_ResourceName0', None), status)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def extract_job_path(ads):
+    """The projection extraction path used by `CondorCache`"""
+    counts = {}
+    for job in ads:
+        cpu, gpu, memory, disk, walltime, singularity, site, resource, status = CondorCache.extract_job(job)
+        key = (Resources.from_condor_row(cpu, gpu, memory, disk, walltime, singularity), site, resource, status)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark job ad extraction and binning on a synthetic ad stream')
+    parser.add_argument('-n', '--num', type=int, default=500000, help='number of ads in the stream')
+    parser.add_argument('--distinct', type=int, default=5000, help='number of distinct ads to cycle through')
+    args = parser.parse_args()
+
+    pool = make_ads(args.distinct)
+
+    results = {}
+    for name, func in (('convert_classads', convert_classads_path), ('extract_job', extract_job_path)):
+        stream = itertools.islice(itertools.cycle(pool), args.num)
+        start = time.perf_counter()
+        results[name] = func(stream)
+        duration = time.perf_counter() - start
+        print(f'{name:>16}: {duration:.2f}s  {args.num/duration:,.0f} ads/s')
+
+    # Undefined values are binned as defaults by extract_job, so only compare totals
+    assert sum(results['convert_classads'].values()) == sum(results['extract_job'].values())
+
+
+if __name__ == '__main__':
+    main()
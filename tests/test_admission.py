@@ -0,0 +1,50 @@
+from pyglidein_server.admission import AdmissionControl
+
+
+def test_unlimited():
+    a = AdmissionControl()
+    for _ in range(100):
+        assert a.admit('h', 'c') is None
+    assert a.in_flight['h'] == 100
+
+def test_handler_limit():
+    a = AdmissionControl(handler_limit=2)
+    assert a.admit('h', 'a') is None
+    assert a.admit('h', 'b') is None
+    assert a.admit('h', 'c') >= 1
+    assert a.admit('other', 'c') is None
+    a.release('h', 'a', duration=.1)
+    assert a.admit('h', 'c') is None
+
+    stats = a.get_stats()['handlers']['h']
+    assert stats['rejected'] == 1
+    assert stats['admitted'] == 3
+    assert stats['max_in_flight'] == 2
+
+def test_client_limit():
+    a = AdmissionControl(client_limit=1)
+    assert a.admit('h', 'a') is None
+    assert a.admit('h2', 'a') is not None
+    assert a.admit('h', 'b') is None
+    a.release('h', 'a')
+    assert a.admit('h2', 'a') is None
+    assert a.get_stats()['clients_in_flight'] == 2
+
+def test_priority():
+    a = AdmissionControl(handler_limit=1, client_limit=1, priority_reserve=1)
+    assert a.admit('h', 'a') is None
+    assert a.admit('h', 'b') is not None
+    assert a.admit('h', 'a', priority=True) is None
+    assert a.admit('h', 'a', priority=True) is not None
+
+def test_retry_after():
+    a = AdmissionControl(handler_limit=2)
+    a.admit('h')
+    a.release('h', duration=10.)
+    assert a.latency['h'] == 10.
+    a.admit('h')
+    a.admit('h')
+    # backlog of 3 requests at 10s each, 2 at a time
+    assert a.admit('h') == 15
+    a.release('h', duration=0.)
+    assert a.latency['h'] == 9.
@@ -0,0 +1,33 @@
+import json
+
+from pyglidein_server.audit import AuditLog
+
+
+def test_record(tmp_path):
+    filename = tmp_path / 'audit.log'
+    a = AuditLog(str(filename))
+    a.record(client='site', result=3)
+    a.record(client='site2', result=0)
+    a.close()
+
+    lines = filename.read_text().splitlines()
+    assert len(lines) == 2
+    ret = json.loads(lines[0])
+    assert ret['client'] == 'site'
+    assert ret['result'] == 3
+    assert 'time' in ret
+    assert a.get_stats()['records'] == 2
+
+def test_sample(tmp_path):
+    a = AuditLog(str(tmp_path / 'audit.log'), sample_rate=0)
+    assert not any(a.sample() for _ in range(100))
+    a.sample_rate = 1
+    assert all(a.sample() for _ in range(100))
+    a.close()
+
+def test_dropped(tmp_path):
+    a = AuditLog(str(tmp_path / 'audit.log'), max_queue=1)
+    a.listener.stop()
+    a.record(client='site')
+    a.record(client='site')
+    assert a.get_stats()['dropped'] == 1
@@ -0,0 +1,51 @@
+from pyglidein_server.auth import TokenCache
+
+
+def test_token_cache():
+    tc = TokenCache()
+    assert tc.get('foo') is None
+    tc.put('foo', {'sub': 'foo'})
+    assert tc.get('foo') == {'sub': 'foo'}
+    assert tc.get_stats() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'flushes': 0}
+
+def test_token_cache_digest():
+    tc = TokenCache()
+    tc.put('foo', {'sub': 'foo'})
+    assert list(tc.data) == [TokenCache.key('foo')]
+    assert tc.get(b'foo') == {'sub': 'foo'}
+
+def test_token_cache_max_age():
+    tc = TokenCache(max_age=10)
+    tc.put('foo', {'sub': 'foo'}, now=100)
+    assert tc.get('foo', now=109) == {'sub': 'foo'}
+    assert tc.get('foo', now=110) is None
+    assert tc.get_stats()['size'] == 0
+
+def test_token_cache_exp():
+    tc = TokenCache(max_age=10)
+    tc.put('foo', {'sub': 'foo', 'exp': 105}, now=100)
+    assert tc.get('foo', now=104) == {'sub': 'foo', 'exp': 105}
+    assert tc.get('foo', now=105) is None
+
+def test_token_cache_lru():
+    tc = TokenCache(size=2)
+    tc.put('foo', {'sub': 'foo'})
+    tc.put('bar', {'sub': 'bar'})
+    tc.get('foo')
+    tc.put('baz', {'sub': 'baz'})
+    assert tc.get('bar') is None
+    assert tc.get('foo') == {'sub': 'foo'}
+    assert tc.get('baz') == {'sub': 'baz'}
+    assert tc.get_stats()['evictions'] == 1
+
+def test_token_cache_disabled():
+    tc = TokenCache(size=0)
+    tc.put('foo', {'sub': 'foo'})
+    assert tc.get('foo') is None
+
+def test_token_cache_flush():
+    tc = TokenCache()
+    tc.put('foo', {'sub': 'foo'})
+    tc.flush()
+    assert tc.get('foo') is None
+    assert tc.get_stats()['flushes'] == 1
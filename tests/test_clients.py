@@ -4,6 +4,7 @@ import json
 import pytest
 
 from pyglidein_server import clients, resources
+from pyglidein_server.audit import AuditLog
 from pyglidein_server.condor import JobCounts
 from pyglidein_server.util import Error
 
@@ -46,6 +47,178 @@ def test_clients_update_multi():
     data = cl.get('foo')
     assert len(data) == 2
 
+def test_clients_update_many():
+    queues = {
+        'foo': {
+            'resources': {},
+            'num_processing': 10,
+            'num_queued': 0,
+        }
+    }
+
+    cl = clients.Clients()
+    cl.update_many({'foo': queues, 'bar': queues})
+
+    assert len(cl.get('foo')) == 1
+    assert len(cl.get('bar')) == 1
+
+def test_clients_update_many_atomic():
+    queues = {
+        'foo': {
+            'resources': {},
+            'num_processing': 10,
+            'num_queued': 0,
+        }
+    }
+
+    cl = clients.Clients()
+    with pytest.raises(Error):
+        cl.update_many({'foo': queues, 'bar': {'foo': {}}})
+    assert cl.get_all() == {}
+
+def test_clients_patch():
+    queues = {
+        'bar': {
+            'resources': {'memory': 2},
+            'num_processing': 10,
+            'num_queued': 11,
+        },
+        'baz': {
+            'resources': {'memory': 4},
+            'num_processing': 12,
+            'num_queued': 13,
+        }
+    }
+
+    cl = clients.Clients()
+    cl.update('foo', queues)
+    res = cl.refs['foo']['baz']
+
+    cl.patch('foo', {'bar': {'num_queued': 1}})
+    data = cl.get('foo')
+    assert len(data) == 2
+    assert data[cl.refs['foo']['bar']] == {'ref': 'bar', 'num_queued': 1, 'num_processing': 10}
+    assert cl.refs['foo']['baz'] is res
+
+    cl.patch('foo', {'bar': None, 'new': {'resources': {}, 'num_queued': 2, 'num_processing': 3}})
+    data = cl.get('foo')
+    assert {q['ref'] for q in data.values()} == {'baz', 'new'}
+
+    cl.patch('foo', {'new': {'resources': {'memory': 4}}})
+    data = cl.get('foo')
+    assert list(data.values()) == [{'ref': 'new', 'num_queued': 2, 'num_processing': 3}]
+
+def test_clients_patch_new_client():
+    cl = clients.Clients()
+    with pytest.raises(Error):
+        cl.patch('foo', {'bar': {'resources': {}, 'num_queued': 2, 'num_processing': 3}})
+    with pytest.raises(Error):
+        cl.patch('foo', {'bar': None})
+    assert 'foo' not in cl.data
+
+def test_clients_patch_bad():
+    queues = {
+        'bar': {
+            'resources': {'memory': 2},
+            'num_processing': 10,
+            'num_queued': 11,
+        },
+    }
+
+    cl = clients.Clients()
+    cl.update('foo', queues)
+    with pytest.raises(Error):
+        cl.patch('foo', {'new': {'num_queued': 2}})
+    with pytest.raises(Error):
+        cl.patch('foo', {'bar': {'foo': 2}})
+    with pytest.raises(Error):
+        cl.patch('foo', {'bar': {'num_queued': 1}, 'baz': {'resources': {'foo': 1}}})
+    assert list(cl.get('foo').values())[0]['num_queued'] == 11
+
+def test_clients_totals():
+    queues = {
+        'bar': {
+            'resources': {'memory': 2},
+            'num_processing': 10,
+            'num_queued': 11,
+        },
+    }
+
+    cl = clients.Clients()
+    cl.update('foo', queues)
+    cl.update('foo2', queues)
+    res = cl.refs['foo']['bar']
+    assert cl.totals[res]['num_queued'] == 22
+    assert cl.totals[res]['num_processing'] == 20
+
+    cl.patch('foo', {'bar': {'num_queued': 1}})
+    assert cl.totals[res]['num_queued'] == 12
+
+    cl.update('foo2', {})
+    assert cl.totals[res]['num_queued'] == 1
+    cl.patch('foo', {'bar': None})
+    assert cl.totals == {}
+
+def test_clients_listener():
+    queues = {
+        'foo': {
+            'resources': {},
+            'num_processing': 10,
+            'num_queued': 0,
+        }
+    }
+
+    changed = []
+    cl = clients.Clients()
+    cl.add_listener(changed.append)
+    cl.update('foo', queues)
+    cl.update_many({'bar': queues})
+    cl.patch('foo', {'foo': {'num_queued': 1}})
+    assert changed == [['foo'], ['bar'], ['foo']]
+
+def test_clients_expire(monkeypatch):
+    queues = {
+        'foo': {
+            'resources': {},
+            'num_processing': 10,
+            'num_queued': 0,
+        }
+    }
+
+    now = 1000.
+    monkeypatch.setattr(clients.time, 'time', lambda: now)
+    cl = clients.Clients(ttl=10)
+    cl.update('foo', queues)
+    cl.update('bar', queues)
+    assert len(cl.totals) == 1
+
+    assert cl.expire(now + 5) == []
+    now += 5
+    cl.update('bar', queues)
+    assert cl.expire(now + 5) == ['foo']
+    assert set(cl.data) == {'bar'}
+    assert cl.get_stats()['evictions'] == 1
+    assert list(cl.totals.values())[0]['num_processing'] == 10
+
+    assert cl.expire(cl.last_seen['bar'] + 10) == ['bar']
+    assert cl.data == {}
+    assert cl.totals == {}
+    assert cl.get_stats() == {'clients': 0, 'ttl': 10, 'evictions': 2}
+
+def test_clients_expire_disabled():
+    queues = {
+        'foo': {
+            'resources': {},
+            'num_processing': 10,
+            'num_queued': 0,
+        }
+    }
+
+    cl = clients.Clients()
+    cl.update('foo', queues)
+    assert cl.expire(float('inf')) == []
+    assert len(cl.get('foo')) == 1
+
 def test_clients_bad_resource():
     queues = {
         'foo': {
@@ -180,3 +353,28 @@ def test_clients_match(glideins, condor, name, expected):
 
     ret = cl.match(name, FakeCondor(condor))
     assert ret == expected
+
+def test_clients_match_many():
+    glideins, condor, _, _ = testdata[8]
+    cl = clients.Clients()
+    for site in glideins:
+        cl.update(site, glideins[site])
+
+    ret = cl.match_many(['site', 'site2'], FakeCondor(condor))
+    assert ret == {'site': {'q1': 1}, 'site2': {}}
+
+def test_clients_match_audit(tmp_path):
+    glideins, condor, _, _ = testdata[8]
+    audit = AuditLog(str(tmp_path / 'audit.log'))
+    cl = clients.Clients(audit=audit)
+    for site in glideins:
+        cl.update(site, glideins[site])
+
+    cl.match('site', FakeCondor(condor))
+    audit.close()
+    records = [json.loads(line) for line in (tmp_path / 'audit.log').read_text().splitlines()]
+    assert len(records) == len(glideins['site'])
+    record = [r for r in records if r['queue'] == 'q1'][0]
+    assert record['client'] == 'site'
+    assert record['result'] == 1
+    assert cl.get_stats()['audit']['records'] == len(records)
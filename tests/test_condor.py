@@ -1,6 +1,8 @@
+import asyncio
 import json
 import time
 import htcondor
+import classad
 import subprocess
 
 from pyglidein_server import condor
@@ -30,6 +32,369 @@ def test_job_counts():
     jc['foo']['bar']['foo'] += 2
     assert jc['foo']['bar']['foo'] == 2
 
+def test_job_counts_views():
+    jc = condor.JobCounts()
+    jc['site']['res']['queued'] += 2
+    jc['site']['res2']['processing'] = 1
+    jc['_sum']['queued'] += 2
+    jc['_sum']['processing'] += 1
+    assert list(jc) == ['site']
+    assert 'site' in jc
+    assert 'other' not in jc
+    assert 'res' in jc['site']
+    assert jc['site']['other']['queued'] == 0
+    assert jc['other']['res']['queued'] == 0
+    assert list(jc) == ['site']
+    assert jc == {'site': {'res': {'queued': 2}, 'res2': {'processing': 1}}}
+    assert jc['_sum'] == {'queued': 2, 'processing': 1}
+    assert jc.to_dict() == {
+        'site': {'res': {'queued': 2}, 'res2': {'processing': 1}},
+        '_sum': {'queued': 2, 'processing': 1},
+    }
+
+def test_job_counts_table():
+    small = condor.Resources({})
+    big = condor.Resources({'memory': 4})
+    table = condor.JobCountsTable()
+    assert table == {}
+    table.add(small, 'site', 'res', 'queued')
+    table.add(small, 'site', 'res', 'queued')
+    table.add(small, None, None, 'processing')
+    table.add(big, 'site', 'res', 'unknown', 3)
+    assert len(table) == 2
+    assert list(table) == [small, big]
+    assert big in table
+    assert condor.Resources({'memory': 8}) not in table
+    with pytest.raises(KeyError):
+        table[condor.Resources({'memory': 8})]
+    assert len(table) == 2
+    assert table[small]['_sum'] == {'queued': 2, 'processing': 1}
+    assert table[small]['site']['res']['queued'] == 2
+    assert table[small][None][None]['processing'] == 1
+    assert table[big]['_sum']['unknown'] == 3
+    assert table[big]['_sum']['queued'] == 0
+
+    table.freeze()
+    assert table[small]['site']['res']['queued'] == 2
+    assert table[small]['site']['foo']['queued'] == 0
+    table.add(small, 'site', 'res', 'queued', 0)
+    assert len(table.row_bin) == 3
+
+    ret = table.to_json()
+    assert ret[hash(small)] == {
+        'site': {'res': {'queued': 2}},
+        None: {None: {'processing': 1}},
+        '_sum': {'queued': 2, 'processing': 1},
+        '_resources': small.resources,
+    }
+    json.dumps(ret)
+
+def test_job_counts_table_merge():
+    small = condor.Resources({})
+    big = condor.Resources({'memory': 4})
+    t1 = condor.JobCountsTable()
+    t1.add(small, 'site', 'res', 'queued')
+    t2 = condor.JobCountsTable()
+    t2.add(big, 'site2', 'res', 'foo')
+    t2.add(small, 'site', 'res', 'queued', 2)
+
+    table = condor.JobCountsTable()
+    table.merge(t1)
+    table.merge(t2)
+    assert table[small].to_dict() == {'site': {'res': {'queued': 3}}, '_sum': {'queued': 3}}
+    assert table[big].to_dict() == {'site2': {'res': {'foo': 1}}, '_sum': {'foo': 1}}
+
+def make_cache(queued, processing=0):
+    cache = {}
+    cache['foo'] = condor.JobCounts()
+    cache['foo']['_sum']['queued'] = queued
+    cache['foo']['_sum']['processing'] = processing
+    return cache
+
+def test_refresh_scheduler_fixed():
+    rs = condor.RefreshScheduler(60)
+    assert rs.update(make_cache(1), 1) == 60
+    assert rs.update(make_cache(100), 1) == 60
+    assert rs.update(make_cache(100), 1) == 60
+
+def test_refresh_scheduler_churn():
+    rs = condor.RefreshScheduler(60, min_timeout=10, max_timeout=300)
+    assert rs.update(make_cache(100), 1) == 60
+    assert rs.update(make_cache(100), 1) == 90
+    assert rs.update(make_cache(200), 1) == 45
+    assert rs.update(make_cache(1000), 1) == 22.5
+    assert rs.update(make_cache(10000), 1) == 11.25
+    assert rs.update(make_cache(100000), 1) == 10
+    for _ in range(20):
+        rs.update(make_cache(100000), 1)
+    assert rs.timeout == 300
+    assert len(rs.history) == 10
+    assert rs.history[-1]['churn'] == 0.
+
+def test_refresh_scheduler_share():
+    rs = condor.RefreshScheduler(60, min_timeout=10, max_timeout=300, max_share=.25)
+    assert rs.update(make_cache(100), 1) == 60
+    assert rs.update(make_cache(1000), 50) == 150
+    assert rs.update(make_cache(100), 200) == 600
+
+def test_refresh_scheduler_bad_args():
+    with pytest.raises(Exception):
+        condor.RefreshScheduler(60, min_timeout=100, max_timeout=10)
+    with pytest.raises(Exception):
+        condor.RefreshScheduler(60, max_share=0)
+
+def test_extract_job():
+    ad = classad.ClassAd({
+        'JobStatus': 2,
+        'RequestCPUs': 2,
+        'RequestMemory': classad.ExprTree('ifThenElse(MemoryUsage isnt undefined, MemoryUsage, 4000)'),
+        'RequestDisk': classad.ExprTree('DiskUsage * 2'),
+        'OriginalTime': 7200,
+        'MachineAttrGLIDEIN_Site0': 'site',
+        'Foo': 'bar',
+    })
+    row = condor.CondorCache.extract_job(ad)
+    assert row == (2, None, 4000, None, 7200, None, 'site', None, 'processing')
+
+    res = condor.Resources.from_condor_row(*row[:6])
+    assert res == condor.Resources.from_condor(condor.CondorCache.convert_classads(ad))
+
+def test_extract_job_status():
+    assert condor.CondorCache.extract_job(classad.ClassAd({}))[-1] == 'queued'
+    assert condor.CondorCache.extract_job(classad.ClassAd({'JobStatus': 1}))[-1] == 'queued'
+    assert condor.CondorCache.extract_job(classad.ClassAd({'JobStatus': 5}))[-1] == 'unknown'
+
+def fake_ads(num):
+    for i in range(num):
+        yield classad.ClassAd({'JobStatus': 1 + i % 2, 'RequestMemory': 2000})
+
+def test_refresh(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', lambda self: fake_ads(2500))
+    cc = condor.CondorCache()
+    cache = cc.get_cached()
+    assert len(cache) == 1
+    assert list(cache.values())[0]['_sum'] == {'queued': 1250, 'processing': 1250}
+
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', lambda self: fake_ads(10))
+    job_counts, duration = cc._count_jobs()
+    # not published until done
+    assert cc.get_cached() is cache
+    assert list(job_counts.values())[0]['_sum'] == {'queued': 5, 'processing': 5}
+    cc._publish(job_counts, duration)
+    assert cc.get_cached() is job_counts
+
+@pytest.mark.asyncio
+async def test_refresh_async(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', lambda self: fake_ads(2500))
+    cc = condor.CondorCache(cache_timeout=100)
+    age = cc.cache_age
+
+    await cc.refresh()
+    assert cc.cache_age == age
+
+    refreshes = []
+    cc.add_listener(refreshes.append)
+    await asyncio.gather(cc.refresh(force=True), cc.refresh(force=True))
+    assert len(refreshes) == 1
+    assert cc.cache_age > age
+    assert cc.refresh_task is None
+
+def test_get_json_cached(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', lambda self: fake_ads(10))
+    cc = condor.CondorCache()
+    ret = cc.get_json()
+    assert len(ret) == 1
+    assert cc.get_json() is ret
+    json.dumps(ret)
+
+class FakeCollector:
+    locates = 0
+    schedds = [{'Name': 'schedd1', 'MyAddress': '<1>'}]
+    def __init__(self, address):
+        pass
+    def locateAll(self, daemon_type):
+        FakeCollector.locates += 1
+        if FakeCollector.schedds is None:
+            raise htcondor.HTCondorIOError('collector down')
+        return [classad.ClassAd(ad) for ad in FakeCollector.schedds]
+
+class FakeSchedd:
+    def __init__(self, ad):
+        self.ad = ad
+    def xquery(self, projection):
+        return None
+
+def test_schedd_cache(monkeypatch):
+    monkeypatch.setattr(condor.htcondor, 'Collector', FakeCollector)
+    monkeypatch.setattr(condor.htcondor, 'Schedd', FakeSchedd)
+    monkeypatch.setattr(condor.htcondor, 'poll', lambda queries: [])
+    FakeCollector.locates = 0
+    FakeCollector.schedds = [{'Name': 'schedd1', 'MyAddress': '<1>'}]
+
+    cc = condor.CondorCache(cache_timeout=0, schedd_timeout=100)
+    assert FakeCollector.locates == 1
+    schedds = cc.get_schedds()
+    assert len(schedds) == 1
+
+    cc._refresh_cache()
+    assert FakeCollector.locates == 1
+
+    # handles are reused when relocating
+    cc.schedds_age = -100
+    FakeCollector.schedds.append({'Name': 'schedd2', 'MyAddress': '<2>'})
+    new_schedds = cc.get_schedds()
+    assert FakeCollector.locates == 2
+    assert len(new_schedds) == 2
+    assert new_schedds[0] is schedds[0]
+
+    # failure falls back to the last known list
+    cc.schedds_age = -100
+    FakeCollector.schedds = None
+    assert cc.get_schedds() == new_schedds
+    assert FakeCollector.locates == 3
+    assert cc.get_stats()['schedds'] == 2
+
+def test_schedd_cache_first_failure(monkeypatch):
+    monkeypatch.setattr(condor.htcondor, 'Collector', FakeCollector)
+    FakeCollector.schedds = None
+    with pytest.raises(htcondor.HTCondorIOError):
+        condor.CondorCache()
+
+def test_lazy(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', lambda self: fake_ads(10))
+    cc = condor.CondorCache(lazy=True)
+    assert not cc.ready
+    assert len(cc.get_cached()) == 0
+    cc.get()
+    assert cc.ready
+    assert len(cc.get_cached()) == 1
+
+BAD_POOLS = set()
+
+def pool_ads(self):
+    if self.collector_address in BAD_POOLS:
+        raise htcondor.HTCondorIOError('pool down')
+    num = 4 if self.collector_address == 'pool1' else 10
+    for i in range(num):
+        yield classad.ClassAd({'JobStatus': 1, 'RequestMemory': 2000 if i % 2 else 4000,
+                               'MachineAttrGLIDEIN_Site0': 'site'})
+
+def test_pools_merge(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'])
+    cache = cp.get()
+    assert len(cache) == 2
+    for jc in cache.values():
+        assert jc['_sum']['queued'] == 7
+        assert jc['site'][None]['queued'] == 7
+
+    ret = cp.get_json()
+    assert len(ret) == 2
+    for v in ret.values():
+        assert v['_pools'] == {'pool1': {'queued': 2}, 'pool2': {'queued': 5}}
+    json.dumps(ret)
+
+    small = condor.Resources({'memory': 2})
+    assert cp.pool_for([small]) == 'pool2'
+    assert cp.pool_for([]) == 'pool1'
+
+@pytest.mark.asyncio
+async def test_pools_failure(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], cache_timeout=0)
+    BAD_POOLS.add('pool2')
+    try:
+        await cp.refresh()
+    finally:
+        BAD_POOLS.clear()
+    cache = cp.get()
+    assert list(cache.values())[0]['_sum']['queued'] == 7
+    stats = cp.get_stats()
+    assert stats['pools']['pool1']['ok']
+    assert not stats['pools']['pool2']['ok']
+    assert stats['pools']['pool2']['failures'] == 1
+
+    # get does not refresh
+    cp.get()
+    assert not cp.get_stats()['pools']['pool2']['ok']
+    await cp.refresh()
+    assert cp.get_stats()['pools']['pool2']['ok']
+
+@pytest.mark.asyncio
+async def test_pools_concurrent_timeout(monkeypatch):
+    def slow_ads(self):
+        time.sleep(.5)
+        return pool_ads(self)
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', slow_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], pool_timeout=.1, lazy=True)
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(.01)
+    ticker = asyncio.ensure_future(tick())
+
+    start = time.monotonic()
+    await cp.refresh()
+    assert time.monotonic() - start < .4
+    assert ticks > 3
+    stats = cp.get_stats()
+    assert not stats['pools']['pool1']['ok']
+    assert not stats['pools']['pool2']['ok']
+
+    # the refreshes still finish in the background
+    await asyncio.sleep(.6)
+    ticker.cancel()
+    assert cp.ready
+    assert cp.get_stats()['pools']['pool1']['ok']
+
+@pytest.mark.asyncio
+async def test_pools_refresh_background(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], cache_timeout=0)
+    refreshes = []
+    cp.add_listener(refreshes.append)
+
+    def slow_ads(self):
+        time.sleep(.3)
+        return pool_ads(self)
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', slow_ads)
+
+    # serves the current snapshot while refreshing
+    start = time.monotonic()
+    await cp.refresh(background=True)
+    await cp.refresh(background=True)
+    assert time.monotonic() - start < .1
+    assert len(cp.get()) == 2
+    assert len(cp.refresh_tasks) == 2
+
+    await cp.refresh()
+    assert len(refreshes) == 2
+    assert not cp.refresh_tasks
+
+@pytest.mark.asyncio
+async def test_pools_refresh_background_not_ready(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], lazy=True)
+    await cp.refresh(background=True)
+    assert cp.ready
+    assert len(cp.get()) == 2
+
+@pytest.mark.asyncio
+async def test_pools_refresh(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], cache_timeout=100)
+    refreshes = []
+    cp.add_listener(refreshes.append)
+    await cp.refresh()
+    assert refreshes == []
+    await cp.refresh(force=True)
+    assert len(refreshes) == 2
+    assert cp.cache_timeout == 100
+
 def test_empty_pool(condor_bootstrap):
     cc = condor.CondorCache()
     assert cc.get_cached() == {}
@@ -105,3 +470,37 @@ def htcondor_installed():
 def test_get_startd_token(condor_bootstrap):
     cc = condor.CondorCache()
     cc.get_startd_token()
+
+@pytest.mark.asyncio
+async def test_pools_warm_up(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], lazy=True)
+    assert not cp.ready
+    assert len(cp.get_cached()) == 0
+
+    BAD_POOLS.add('pool2')
+    try:
+        await cp.warm_up()
+    finally:
+        BAD_POOLS.clear()
+    # a failed pool does not block readiness
+    assert cp.ready
+    assert list(cp.get_cached().values())[0]['_sum']['queued'] == 2
+
+@pytest.mark.asyncio
+async def test_pools_warm_up_retry(monkeypatch):
+    monkeypatch.setattr(condor.CondorCache, '_query_ads', pool_ads)
+    cp = condor.CondorPools(['pool1', 'pool2'], lazy=True)
+
+    BAD_POOLS.update(['pool1', 'pool2'])
+    try:
+        task = cp.warm_up(retry_delay=.01)
+        await asyncio.sleep(.05)
+        assert not cp.ready
+        assert not task.done()
+        assert cp.get_stats()['pools']['pool1']['failures'] > 1
+    finally:
+        BAD_POOLS.clear()
+
+    await asyncio.wait_for(task, 1)
+    assert cp.ready
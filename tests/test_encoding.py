@@ -0,0 +1,52 @@
+import pytest
+from tornado.web import HTTPError
+
+from pyglidein_server import encoding
+from pyglidein_server.util import Error
+
+
+data = {'foo': {'resources': {'memory': 2}, 'num_queued': 1, 'num_processing': 2}}
+
+@pytest.mark.parametrize('media_type', [encoding.JSON, encoding.MSGPACK, encoding.CBOR])
+def test_roundtrip(media_type):
+    body = encoding.encode(data, media_type)
+    assert encoding.decode(body, media_type) == data
+
+def test_decode_default_json():
+    body = encoding.encode(data, encoding.JSON)
+    assert encoding.decode(body) == data
+    assert encoding.decode(body, 'application/json; charset=UTF-8') == data
+
+def test_decode_alias():
+    body = encoding.encode(data, encoding.MSGPACK)
+    assert encoding.decode(body, 'application/x-msgpack') == data
+
+@pytest.mark.parametrize('content_type', ['text/plain', 'application/x-www-form-urlencoded'])
+def test_decode_unrecognized_json(content_type):
+    body = encoding.encode(data, encoding.JSON)
+    assert encoding.decode(body, content_type) == data
+    with pytest.raises(Error):
+        encoding.decode(b'foo', content_type)
+
+def test_decode_unsupported(monkeypatch):
+    monkeypatch.setattr(encoding, 'msgpack', None)
+    with pytest.raises(HTTPError) as exc_info:
+        encoding.decode(b'foo', encoding.MSGPACK)
+    assert exc_info.value.status_code == 415
+
+def test_decode_invalid():
+    with pytest.raises(Error):
+        encoding.decode(b'{foo', encoding.JSON)
+
+@pytest.mark.parametrize('accept,expected', [
+    (None, encoding.JSON),
+    ('', encoding.JSON),
+    ('*/*', encoding.JSON),
+    ('text/html', encoding.JSON),
+    ('application/msgpack', encoding.MSGPACK),
+    ('application/cbor, application/json', encoding.CBOR),
+    ('application/json;q=0.5, application/cbor', encoding.CBOR),
+    ('application/msgpack;q=0.1, application/json', encoding.JSON),
+])
+def test_negotiate(accept, expected):
+    assert encoding.negotiate(accept) == expected
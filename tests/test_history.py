@@ -0,0 +1,71 @@
+import pytest
+
+from pyglidein_server.history import History
+from pyglidein_server.resources import Resources
+from pyglidein_server.util import Error
+
+
+def jobs(queued, processing):
+    return {Resources({'memory': 2}): {'_sum': {'queued': queued, 'processing': processing}}}
+
+def glideins(queued, processing):
+    return {Resources({'memory': 2}): {'num_queued': queued, 'num_processing': processing}}
+
+def test_record():
+    h = History(resolutions=[10, 60], size=6)
+    h.record(jobs(10, 0), {}, now=1000)
+    h.record(jobs(20, 2), glideins(1, 2), now=1005)
+    h.record(jobs(30, 4), glideins(3, 4), now=1010)
+
+    ret = h.query(start=1000, end=1010, resolution=10, now=1010)
+    assert ret['resolution'] == 10
+    assert ret['times'] == [1000, 1010]
+    assert ret['total']['jobs_queued'] == [15., 30.]
+    assert ret['total']['jobs_processing'] == [1., 4.]
+    assert ret['total']['glideins_queued'] == [0.5, 3.]
+    series = list(ret['bins'].values())[0]
+    assert series['_resources']['memory'] == 2
+    assert series['glideins_processing'] == [1., 4.]
+
+    ret = h.query(start=960, end=1010, resolution=60, now=1010)
+    assert ret['times'] == [960]
+    assert ret['total']['jobs_queued'] == [20.]
+
+def test_ring():
+    h = History(resolutions=[10], size=3)
+    for t in range(0, 100, 10):
+        h.record(jobs(t, 0), {}, now=t)
+    ret = h.query(start=0, end=90, now=90)
+    # older intervals have been overwritten
+    assert ret['times'] == [70, 80, 90]
+    assert ret['total']['jobs_queued'] == [70., 80., 90.]
+    assert len(h.sums[10][0]) == 3 * len(History.METRICS)
+
+def test_gaps():
+    h = History(resolutions=[10], size=6)
+    h.record(jobs(1, 0), {}, now=0)
+    h.record(jobs(3, 0), {}, now=30)
+    ret = h.query(start=0, end=30, now=30)
+    assert ret['total']['jobs_queued'] == [1., None, None, 3.]
+
+def test_max_bins():
+    h = History(resolutions=[10], size=6, max_bins=1)
+    data = jobs(1, 0)
+    data[Resources({'memory': 4})] = {'_sum': {'queued': 2, 'processing': 0}}
+    h.record(data, {}, now=0)
+    ret = h.query(start=0, end=0, now=0)
+    assert len(ret['bins']) == 1
+    assert ret['total']['jobs_queued'] == [3.]
+    assert h.get_stats() == {'bins': 1, 'dropped': 1}
+
+def test_auto_resolution():
+    h = History(resolutions=[10, 60], size=6)
+    assert h.query(start=0, end=60, now=60)['resolution'] == 10
+    assert h.query(start=0, end=100, now=100)['resolution'] == 60
+
+def test_bad_query():
+    h = History()
+    with pytest.raises(Error):
+        h.query(start=10, end=0)
+    with pytest.raises(Error):
+        h.query(resolution=7)
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from pyglidein_server.notify import Notifier
+
+
+@pytest.mark.asyncio
+async def test_timeout():
+    n = Notifier()
+    assert await n.wait(.01) is False
+
+@pytest.mark.asyncio
+async def test_notify():
+    n = Notifier()
+    waiters = [asyncio.ensure_future(n.wait(10)) for _ in range(3)]
+    await asyncio.sleep(0)
+    n.notify()
+    assert await asyncio.gather(*waiters) == [True, True, True]
+
+@pytest.mark.asyncio
+async def test_notify_no_waiters():
+    n = Notifier()
+    n.notify()
+    assert await n.wait(.01) is False
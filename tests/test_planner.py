@@ -0,0 +1,104 @@
+import pytest
+
+from pyglidein_server import clients, planner as planner_module
+from pyglidein_server.planner import Planner
+
+from .test_clients import testdata, FakeCondor
+
+
+class FakePools(FakeCondor):
+    def get_cached(self):
+        return self.data
+
+QUEUE = {
+    'q1': {
+        'resources': {'memory': 4},
+        'num_queued': 0,
+        'num_processing': 0,
+    },
+}
+CONDOR = [{'resources': {'memory': 2}, 'queued': 10, 'processing': 0}]
+
+@pytest.mark.parametrize('glideins,condor,name,expected', [t for t in testdata if len(t[0]) == 1])
+def test_planner_match_parity(glideins, condor, name, expected):
+    cl = clients.Clients()
+    for site in glideins:
+        cl.update(site, glideins[site])
+
+    planner = Planner(cl, FakePools(condor))
+    assert planner.take(name) == cl.match(name, FakeCondor(condor)) == expected
+
+def test_planner_shared_demand():
+    cl = clients.Clients()
+    cl.update('site1', QUEUE)
+    cl.update('site2', QUEUE)
+    assert cl.match('site1', FakeCondor(CONDOR)) == {'q1': 5}
+    assert cl.match('site2', FakeCondor(CONDOR)) == {'q1': 5}
+
+    # the demand is only allocated once
+    planner = Planner(cl, FakePools(CONDOR))
+    ret = [planner.take('site1'), planner.take('site2')]
+    assert sorted(ret, key=len) == [{}, {'q1': 5}]
+
+def test_planner_take_once():
+    cl = clients.Clients()
+    planner = Planner(cl, FakePools(CONDOR), update_threshold=2)
+    cl.add_listener(planner.clients_updated)
+    cl.update('site1', QUEUE)
+    assert planner.take('site1') == {'q1': 5}
+    assert planner.take('site1') == {}
+    assert planner.plans == 1
+
+    # new clients are planned on top of the current plan
+    cl.update('site2', QUEUE)
+    assert planner.take('site2') == {}
+
+    cl.update('site1', QUEUE)
+    assert planner.dirty
+    planner.take('site1')
+    assert planner.plans == 2
+
+def test_planner_condor_refresh():
+    cl = clients.Clients()
+    cl.update('site1', QUEUE)
+    planner = Planner(cl, FakePools(CONDOR))
+    assert planner.take('site1') == {'q1': 5}
+    planner.condor_refreshed()
+    assert planner.take('site1') == {'q1': 5}
+    assert planner.get_stats()['plans'] == 2
+
+def test_planner_silent_site(monkeypatch):
+    now = 1000.
+    monkeypatch.setattr(planner_module.time, 'monotonic', lambda: now)
+    cl = clients.Clients()
+    cl.update('site1', QUEUE)
+    cl.update('site2', QUEUE)
+    planner = Planner(cl, FakePools(CONDOR), active_window=10)
+    assert planner.take('site1') == {'q1': 5}
+    assert planner.take('site2') == {}
+
+    # site2 goes silent, and would be first in the next plan
+    now += 20
+    planner.condor_refreshed()
+    assert planner.take('site1') == {'q1': 5}
+    assert 'site2' not in planner.allocations
+
+    # it is planned again once it polls
+    assert planner.take('site2') == {}
+
+def test_planner_restore():
+    cl = clients.Clients()
+    cl.update('site1', QUEUE)
+    planner = Planner(cl, FakePools(CONDOR))
+    ret = planner.take('site1')
+    assert ret == {'q1': 5}
+    planner.restore('site1', ret)
+    assert planner.take('site1') == {'q1': 5}
+
+    # a share from an older plan is dropped
+    ret = planner.take('site1')
+    planner.condor_refreshed()
+    assert planner.take('site1') == {'q1': 5}
+    planner.restore('site1', {'q1': 5})
+    planner.restore('site1', {'q1': 5})
+    assert planner.take('site1') == {'q1': 5}
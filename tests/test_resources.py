@@ -25,6 +25,21 @@ def test_resources_condor_time():
     r = Resources.from_condor({'OriginalTime': 7200})
     assert r.resources['time'] == 2
 
+@pytest.mark.parametrize('ads', [
+    {},
+    {'RequestCPUs': 2, 'RequestMemory': 4500, 'RequestDisk': 2000000},
+    {'RequestGPUs': 1, 'OriginalTime': 7200, 'SingularityImage': '/cvmfs/foo'},
+])
+def test_resources_condor_row(ads):
+    r = Resources.from_condor_row(ads.get('RequestCPUs'), ads.get('RequestGPUs'),
+                                  ads.get('RequestMemory'), ads.get('RequestDisk'),
+                                  ads.get('OriginalTime'), ads.get('SingularityImage'))
+    assert r == Resources.from_condor(ads)
+
+def test_resources_condor_row_cached():
+    r = Resources.from_condor_row(2, None, 2000, None, None, None)
+    assert r is Resources.from_condor_row(2, None, 2000, None, None, None)
+
 def test_resources_condor_singularity():
     r = Resources.from_condor({'SingularityImage': True})
     assert r.resources['singularity'] == True
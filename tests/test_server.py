@@ -1,11 +1,18 @@
 import pytest
 import socket
 import asyncio
+import json
+import time
 
+import cbor2
+import msgpack
 import requests
 from rest_tools.client import RestClient
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 from rest_tools.server import Auth
 
+from pyglidein_server.admission import AdmissionControl
+from pyglidein_server.condor import CondorPools
 from pyglidein_server.server import create_server
 
 @pytest.fixture
@@ -20,31 +27,52 @@ def port():
     return ephemeral_port
 
 @pytest.fixture
-async def server(monkeypatch, port, request):
+async def server_address(monkeypatch, port, request):
     marker = request.node.get_closest_marker('role')
     role = marker.args[0] if marker else 'client'
+    payload = {'role': role}
+    if marker:
+        payload.update(marker.kwargs)
 
     monkeypatch.setenv('DEBUG', 'True')
     monkeypatch.setenv('PORT', str(port))
+    marker = request.node.get_closest_marker('env')
+    if marker:
+        for k, v in marker.kwargs.items():
+            monkeypatch.setenv(k, v)
 
     secret = 'secret'
     monkeypatch.setenv('AUTH_SECRET', secret)
     a = Auth(secret, issuer='pyglidein')
-    token = a.create_token('user', type='client', payload={'role': role})
+    token = a.create_token('user', type='client', payload=payload)
 
     s = create_server()
 
+    # wait for the condor cache to warm up
+    for _ in range(100):
+        ret = await AsyncHTTPClient().fetch(f'http://localhost:{port}/readyz', raise_error=False)
+        if ret.code == 200:
+            break
+        await asyncio.sleep(0.01)
+
     try:
-        yield RestClient(f'http://localhost:{port}', token=token, timeout=0.1, retries=0)
+        yield f'http://localhost:{port}', token
     finally:
         await s.stop()
 
+@pytest.fixture
+async def server(server_address):
+    address, token = server_address
+    yield RestClient(address, token=token, timeout=0.1, retries=0)
+
 @pytest.mark.asyncio
 @pytest.mark.role('foo')
 async def test_status_noauth(server):
     ret = await server.request('GET', '/status')
     assert 'condor' in ret
     assert 'clients' in ret
+    assert ret['stats']['clients']['evictions'] == 0
+    assert ret['stats']['condor']['cache_timeout'] > 0
 
 @pytest.mark.asyncio
 @pytest.mark.role('client')
@@ -59,6 +87,13 @@ async def test_tokens(server):
     assert 'token' in ret
     assert ret['client'] == 'foo'
 
+@pytest.mark.asyncio
+@pytest.mark.role('admin')
+async def test_tokens_gateway(server):
+    ret = await server.request('POST', '/api/tokens', {'client': 'gw', 'clients': ['foo', 'bar']})
+    assert 'token' in ret
+    assert ret['clients'] == ['foo', 'bar']
+
 @pytest.mark.asyncio
 @pytest.mark.role('client')
 async def test_put_empty(server):
@@ -109,3 +144,264 @@ async def test_client_queue_fail(server):
                 'num_processing': 1,
             }
         })
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_client_queue_msgpack(server_address):
+    address, token = server_address
+    body = msgpack.packb({
+        'foo': {
+            'resources': {},
+            'num_queued': 0,
+            'num_processing': 1,
+        }
+    })
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user/actions/queue',
+                                        method='POST', body=body, headers={
+                                            'Authorization': f'Bearer {token}',
+                                            'Content-Type': 'application/msgpack',
+                                            'Accept': 'application/msgpack',
+                                        })
+    assert ret.headers['Content-Type'] == 'application/msgpack'
+    assert msgpack.unpackb(ret.body) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_client_put_cbor(server_address):
+    address, token = server_address
+    body = cbor2.dumps({
+        'foo': {
+            'resources': {},
+            'num_queued': 0,
+            'num_processing': 1,
+        }
+    })
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user',
+                                        method='PUT', body=body, headers={
+                                            'Authorization': f'Bearer {token}',
+                                            'Content-Type': 'application/cbor',
+                                            'Accept': 'application/cbor',
+                                        })
+    assert ret.headers['Content-Type'] == 'application/cbor'
+    assert cbor2.loads(ret.body) == {}
+
+    ret = await AsyncHTTPClient().fetch(f'{address}/status', headers={'Accept': 'application/cbor'})
+    status = cbor2.loads(ret.body)
+    assert len(status['clients']['user']) == 1
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_client_put_bad_content_type(server_address):
+    address, token = server_address
+    # unrecognized types are decoded as json, like curl -d sends
+    for content_type in ('text/plain', 'application/x-www-form-urlencoded'):
+        await AsyncHTTPClient().fetch(f'{address}/api/clients/user',
+                                      method='PUT', body=json.dumps(QUEUES), headers={
+                                          'Authorization': f'Bearer {token}',
+                                          'Content-Type': content_type,
+                                      })
+
+    with pytest.raises(HTTPClientError) as exc_info:
+        await AsyncHTTPClient().fetch(f'{address}/api/clients/user',
+                                      method='PUT', body=b'foo', headers={
+                                          'Authorization': f'Bearer {token}',
+                                          'Content-Type': 'text/plain',
+                                      })
+    assert exc_info.value.code == 400
+
+QUEUES = {
+    'foo': {
+        'resources': {},
+        'num_queued': 0,
+        'num_processing': 1,
+    }
+}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_batch_queue_client(server):
+    ret = await server.request('POST', '/api/actions/queue', {'user': QUEUES})
+    assert ret == {'clients': {'user': {}}}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_batch_queue_client_fail(server):
+    with pytest.raises(Exception):
+        await server.request('POST', '/api/actions/queue', {'user': QUEUES, 'foo': QUEUES})
+    ret = await server.request('GET', '/status')
+    assert ret['clients'] == {}
+
+@pytest.mark.asyncio
+@pytest.mark.role('gateway', clients=['foo', 'bar'])
+async def test_batch_queue_gateway(server):
+    ret = await server.request('POST', '/api/actions/queue', {'foo': QUEUES, 'bar': QUEUES})
+    assert ret == {'clients': {'foo': {}, 'bar': {}}}
+
+    ret = await server.request('POST', '/api/actions/queue', {'foo': None})
+    assert ret == {'clients': {'foo': {}}}
+
+    ret = await server.request('PUT', '/api/clients/foo', QUEUES)
+
+    with pytest.raises(Exception):
+        await server.request('POST', '/api/actions/queue', {'baz': QUEUES})
+
+@pytest.mark.asyncio
+@pytest.mark.role('admin')
+async def test_batch_queue_missing_status(server):
+    with pytest.raises(Exception):
+        await server.request('POST', '/api/actions/queue', {'foo': None})
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_patch(server):
+    await server.request('PUT', '/api/clients/user', QUEUES)
+    await server.request('PATCH', '/api/clients/user', {'foo': {'num_queued': 2}})
+    ret = await server.request('GET', '/status')
+    assert list(ret['clients']['user'].values())[0]['num_queued'] == 2
+
+    with pytest.raises(Exception):
+        await server.request('PATCH', '/api/clients/user', {'bar': {'num_queued': 2}})
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_client_queue_partial(server):
+    await server.request('PUT', '/api/clients/user', QUEUES)
+    ret = await server.request('POST', '/api/clients/user/actions/queue?partial=true', {'foo': {'num_queued': 3}})
+    assert ret == {}
+    ret = await server.request('GET', '/status')
+    assert list(ret['clients']['user'].values())[0]['num_queued'] == 3
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_client_queue_long_poll(server_address):
+    address, token = server_address
+    start = time.monotonic()
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user/actions/queue?wait=0.2',
+                                        method='POST', body=json.dumps(QUEUES), headers={
+                                            'Authorization': f'Bearer {token}',
+                                            'Content-Type': 'application/json',
+                                        })
+    assert time.monotonic() - start >= 0.2
+    assert json.loads(ret.body) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+@pytest.mark.parametrize('wait', ['foo', 'nan', 'inf', '-1'])
+async def test_client_queue_long_poll_bad_wait(server, wait):
+    with pytest.raises(requests.HTTPError) as exc_info:
+        await server.request('POST', f'/api/clients/user/actions/queue?wait={wait}', QUEUES)
+    assert exc_info.value.response.status_code == 400
+
+@pytest.mark.asyncio
+@pytest.mark.role('admin')
+async def test_token_cache(server):
+    await server.request('PUT', '/api/clients/foo', QUEUES)
+    await server.request('PUT', '/api/clients/foo', QUEUES)
+    ret = await server.request('GET', '/status')
+    assert ret['stats']['auth']['hits'] >= 1
+    assert ret['stats']['auth']['size'] == 1
+
+    await server.request('DELETE', '/api/tokens/cache')
+    ret = await server.request('GET', '/status')
+    assert ret['stats']['auth']['flushes'] == 1
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_token_cache_flush_fail(server):
+    with pytest.raises(Exception):
+        await server.request('DELETE', '/api/tokens/cache')
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_admission_rejected(server_address, monkeypatch):
+    monkeypatch.setattr(AdmissionControl, 'admit', lambda *args, **kwargs: 7)
+    address, token = server_address
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user/actions/queue',
+                                        method='POST', body=json.dumps(QUEUES), raise_error=False, headers={
+                                            'Authorization': f'Bearer {token}',
+                                            'Content-Type': 'application/json',
+                                        })
+    assert ret.code == 503
+    assert ret.headers['Retry-After'] == '7'
+
+    # status is never rejected
+    ret = await AsyncHTTPClient().fetch(f'{address}/status')
+    assert ret.code == 200
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+@pytest.mark.env(ADMISSION_CLIENT_LIMIT='1')
+async def test_admission_long_poll(server_address):
+    address, token = server_address
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+    }
+    waiter = AsyncHTTPClient().fetch(f'{address}/api/clients/user/actions/queue?wait=0.2',
+                                     method='POST', body=json.dumps(QUEUES), headers=headers)
+    await asyncio.sleep(0.05)
+    # the long poll does not hold the client's slot while waiting
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user', method='PUT',
+                                        body=json.dumps(QUEUES), headers=headers)
+    assert ret.code == 200
+    await waiter
+
+    ret = await AsyncHTTPClient().fetch(f'{address}/status')
+    stats = json.loads(ret.body)['stats']['admission']
+    assert stats['handlers']['APIClientQueue']['admitted'] == 1
+    assert stats['handlers']['APIClient']['in_flight'] == 0
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_not_ready(server_address, monkeypatch):
+    monkeypatch.setattr(CondorPools, 'ready', False)
+    address, token = server_address
+    ret = await AsyncHTTPClient().fetch(f'{address}/healthz')
+    assert json.loads(ret.body) == {'status': 'ok'}
+
+    ret = await AsyncHTTPClient().fetch(f'{address}/readyz', raise_error=False)
+    assert ret.code == 503
+    assert json.loads(ret.body) == {'ready': False}
+
+    ret = await AsyncHTTPClient().fetch(f'{address}/api/clients/user/actions/queue',
+                                        method='POST', body=json.dumps(QUEUES), raise_error=False, headers={
+                                            'Authorization': f'Bearer {token}',
+                                            'Content-Type': 'application/json',
+                                        })
+    assert ret.code == 503
+    assert ret.headers['Retry-After'] == '5'
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_ready(server_address):
+    address, token = server_address
+    ret = await AsyncHTTPClient().fetch(f'{address}/readyz')
+    assert json.loads(ret.body) == {'ready': True}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_history(server):
+    await server.request('PUT', '/api/clients/user', QUEUES)
+    ret = await server.request('GET', '/api/history?resolution=60')
+    assert ret['resolution'] == 60
+    assert ret['total']['glideins_processing'][-1] > 0
+
+    with pytest.raises(Exception):
+        await server.request('GET', '/api/history?start=foo')
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+@pytest.mark.parametrize('query', ['start=-inf', 'start=nan', 'end=nan', 'end=inf', 'resolution=inf'])
+async def test_history_not_finite(server, query):
+    with pytest.raises(requests.HTTPError) as exc_info:
+        await server.request('GET', f'/api/history?{query}')
+    assert exc_info.value.response.status_code == 400
+
+@pytest.mark.asyncio
+@pytest.mark.role('admin')
+async def test_client_named_actions(server):
+    await server.request('PUT', '/api/clients/actions', QUEUES)
+    ret = await server.request('POST', '/api/clients/actions/actions/queue', QUEUES)
+    assert ret == {}
+    ret = await server.request('POST', '/api/actions/queue', {'actions': None})
+    assert ret == {'clients': {'actions': {}}}
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import pytest
+import requests
+
+from pyglidein_server.admission import AdmissionControl
+from pyglidein_server.condor import CondorPools
+from pyglidein_server.planner import Planner
+from pyglidein_server.site_client import SiteClient
+
+from .test_server import port, server_address, QUEUES  # noqa: F401
+
+
+@pytest.fixture
+async def site_client(server_address):  # noqa: F811
+    address, token = server_address
+    async with SiteClient(address, token, 'user', timeout=1, retries=2, backoff=0.01) as client:
+        yield client
+
+async def get_status(client):
+    return await client.request('GET', '/status')
+
+def test_retry_delay():
+    client = SiteClient('http://localhost', 'token', 'user', backoff=1, max_backoff=4)
+    for attempt in range(1, 6):
+        delay = client.retry_delay(attempt)
+        assert min(4, 2 ** (attempt - 1)) / 2 <= delay <= min(4, 2 ** (attempt - 1))
+
+    response = requests.Response()
+    response.headers['Retry-After'] = '7'
+    assert client.retry_delay(1, response) == 7
+
+def test_have_tokens():
+    client = SiteClient('http://localhost', 'token', 'user')
+    now = time.time()
+    client.startd_tokens = {'a': ('t', now + 1000), 'b': ('old', now - 1), 'c': ('soon', now + 1)}
+    assert client._have_tokens(10) == {'a': 't'}
+    assert 'b' not in client.startd_tokens
+    client.close()
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_thread_sessions(server_address):  # noqa: F811
+    address, token = server_address
+    async with SiteClient(address, token, 'user', timeout=1, pool_size=2) as client:
+        await asyncio.gather(*(get_status(client) for _ in range(6)))
+        assert 1 <= len(client.sessions) <= 2
+    assert not client.sessions
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_queue_partial(site_client):
+    assert await site_client.queue(QUEUES) == {}
+    ret = await get_status(site_client)
+    assert list(ret['clients']['user'].values())[0]['num_queued'] == 0
+
+    assert site_client._changes(QUEUES) is None
+    assert await site_client.queue(QUEUES) == {}
+
+    queues = {'foo': dict(QUEUES['foo'], num_queued=3)}
+    assert site_client._changes(queues) == {'foo': {'num_queued': 3}}
+    await site_client.queue(queues)
+    ret = await get_status(site_client)
+    assert list(ret['clients']['user'].values())[0]['num_queued'] == 3
+
+    assert site_client._changes({}) == {'foo': None}
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_queue_evicted(site_client):
+    # the server does not know this client, so partial updates fail
+    site_client.last_sent = QUEUES
+    assert await site_client.queue(QUEUES) == {}
+    ret = await get_status(site_client)
+    assert 'user' in ret['clients']
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_queue_evicted_resend(site_client):
+    # the server lost this client, and the delta only adds a queue
+    queues = dict(QUEUES, bar={'resources': {'memory': 2}, 'num_queued': 1, 'num_processing': 0})
+    site_client.last_sent = QUEUES
+    assert await site_client.queue(queues) == {}
+    ret = await get_status(site_client)
+    assert len(ret['clients']['user']) == 2
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_retry_after(site_client, monkeypatch):
+    calls = []
+
+    def admit(self, *args, **kwargs):
+        calls.append(args)
+        return 0 if len(calls) == 1 else None
+    monkeypatch.setattr(AdmissionControl, 'admit', admit)
+    await site_client.update(QUEUES)
+    assert len(calls) == 2
+
+    monkeypatch.setattr(AdmissionControl, 'admit', lambda *args, **kwargs: 0)
+    with pytest.raises(requests.HTTPError):
+        await site_client.update(QUEUES)
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_startd_token_cache(site_client, monkeypatch):
+    tokens = []
+
+    def get_startd_token(self, pool=None):
+        tokens.append(pool)
+        return 'startd'
+    monkeypatch.setattr(CondorPools, 'get_startd_token', get_startd_token)
+    monkeypatch.setattr(Planner, 'take', lambda self, name: {'foo': 1})
+
+    ret = await site_client.queue(QUEUES)
+    assert ret['queues'] == {'foo': 1}
+    assert ret['token'] == 'startd'
+    ret = await site_client.queue(QUEUES)
+    assert ret['token'] == 'startd'
+    assert len(tokens) == 1
+
+    # expired tokens are fetched again
+    site_client.startd_tokens[ret['pool']] = ('old', 0)
+    ret = await site_client.queue(QUEUES)
+    assert ret['token'] == 'startd'
+    assert len(tokens) == 2
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_startd_token_failure(site_client, monkeypatch):
+    def get_startd_token(self, pool=None):
+        raise Exception('no token')
+    restored = []
+    monkeypatch.setattr(CondorPools, 'get_startd_token', get_startd_token)
+    monkeypatch.setattr(Planner, 'take', lambda self, name: {'foo': 1})
+    monkeypatch.setattr(Planner, 'restore', lambda self, name, ret: restored.append((name, ret)))
+
+    with pytest.raises(requests.HTTPError):
+        await site_client.queue(QUEUES)
+    assert restored == [('user', {'foo': 1})]
+
+@pytest.mark.asyncio
+@pytest.mark.role('client')
+async def test_queue_long_poll(server_address):  # noqa: F811
+    address, token = server_address
+    async with SiteClient(address, token, 'user', timeout=.1, retries=2, backoff=.01) as client:
+        start = time.monotonic()
+        assert await client.queue(QUEUES, wait=.3) == {}
+        assert time.monotonic() - start >= .3
+
+        # one long poll, without timeouts and retries
+        ret = await get_status(client)
+        assert ret['stats']['admission']['handlers']['APIClientQueue']['admitted'] == 1
@@ -0,0 +1,103 @@
+import gzip
+
+import pytest
+
+from pyglidein_server import clients, trace
+from pyglidein_server.condor import JobCountsTable
+from pyglidein_server.resources import Resources
+
+QUEUES = {
+    'q1': {
+        'resources': {'memory': 4},
+        'num_queued': 0,
+        'num_processing': 0,
+    },
+}
+
+def record(filename):
+    rec = trace.TraceRecorder(filename)
+    jobs = JobCountsTable()
+    jobs.add(Resources({'memory': 2}), None, None, 'queued', 10)
+    jobs.freeze()
+    rec.record_condor(jobs)
+
+    cl = clients.Clients()
+    cl.add_listener(lambda names: rec.record_clients(cl, names))
+    cl.update('site1', QUEUES)
+    cl.update('site2', QUEUES)
+    rec.record_match('site1', {'q1': 5})
+    rec.record_match('site2', {'q1': 5})
+    rec.close()
+    return rec
+
+@pytest.mark.parametrize('name', ['trace.jsonl', 'trace.jsonl.gz'])
+def test_record(tmp_path, name):
+    rec = record(str(tmp_path / name))
+    assert rec.get_stats()['events'] == 5
+
+    events = list(trace.read_trace(str(tmp_path / name)))
+    assert [e['event'] for e in events] == ['condor', 'update', 'update', 'match', 'match']
+    assert events[0]['bins'][0][1:] == [10, 0]
+    assert events[1]['queues']['q1']['resources']['memory'] == 4
+
+def test_replay(tmp_path):
+    filename = str(tmp_path / 'trace.jsonl')
+    record(filename)
+
+    ret = trace.replay(trace.read_trace(filename))
+    assert ret['events'] == 5
+    assert ret['matches'] == 2
+    assert ret['glideins'] == {'site1': 5, 'site2': 5}
+    assert ret['recorded_glideins'] == {'site1': 5, 'site2': 5}
+    assert ret['match_latency']['max'] >= ret['match_latency']['p50']
+
+    # the planner does not hand out the same demand twice
+    ret = trace.replay(trace.read_trace(filename), planner_updates=10)
+    assert sum(ret['glideins'].values()) == 5
+
+def test_replay_speed(tmp_path):
+    events = [
+        {'t': 0., 'event': 'update', 'client': 'site1', 'queues': QUEUES},
+        {'t': .1, 'event': 'match', 'client': 'site1', 'result': {}},
+    ]
+    ret = trace.replay(events, speed=2)
+    assert ret['duration'] >= .05
+    assert ret['glideins'] == {'site1': 0}
+
+def test_gzip_crash_and_restart(tmp_path):
+    filename = str(tmp_path / 'trace.jsonl.gz')
+    rec = trace.TraceRecorder(filename, flush_events=2)
+    for i in range(3):
+        rec.record_match('site', {'q1': i})
+    # exit without close, losing the buffered event
+    rec.file.close()
+
+    # a write cut off part way through a member
+    with open(filename, 'ab') as f:
+        f.write(gzip.compress(b'{"event":"match"}\n' * 100)[:-20])
+
+    rec = trace.TraceRecorder(filename)
+    rec.record_match('site', {'q1': 3})
+    rec.close()
+
+    events = list(trace.read_trace(filename))
+    assert [e['result']['q1'] for e in events] == [0, 1, 3]
+
+def test_gzip_truncated_end(tmp_path):
+    filename = str(tmp_path / 'trace.jsonl.gz')
+    rec = trace.TraceRecorder(filename)
+    rec.record_match('site', {'q1': 1})
+    rec.close()
+    with open(filename, 'ab') as f:
+        f.write(gzip.compress(b'{"event":"match"}\n')[:-5])
+    assert len(list(trace.read_trace(filename))) == 1
+
+def test_plain_partial_line(tmp_path):
+    filename = str(tmp_path / 'trace.jsonl')
+    rec = trace.TraceRecorder(filename)
+    rec.record_match('site', {'q1': 1})
+    # written through right away
+    assert len(list(trace.read_trace(filename))) == 1
+    rec.file.write(b'{"event":"ma')
+    rec.close()
+    assert len(list(trace.read_trace(filename))) == 1